@@ -0,0 +1,148 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import os
+import sys
+import time
+import optuna
+import logging
+import tempfile
+import numpy as np
+from argparse import ArgumentParser
+from aimlutils.echo.src.samplers import CachedTrialsSampler
+from aimlutils.echo.src.engine import batched_storage
+
+
+def args():
+    parser = ArgumentParser(description=
+        "sampler_cache.py: Time the suggestions of the TPESampler with and without the trial cache (and its max_history)"
+    )
+
+    parser.add_argument(
+        "-n",
+        "--n_trials",
+        dest="n_trials",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+        help="The study sizes to time. Default is 1000 10000 50000."
+    )
+
+    parser.add_argument(
+        "-p",
+        "--n_params",
+        dest="n_params",
+        type=int,
+        default=10,
+        help="The number of parameters suggested in each trial. Default is 10."
+    )
+
+    parser.add_argument(
+        "-r",
+        "--repeats",
+        dest="repeats",
+        type=int,
+        default=10,
+        help="The number of trials sampled at each size. Default is 10."
+    )
+
+    parser.add_argument(
+        "-m",
+        "--max_history",
+        dest="max_history",
+        type=int,
+        default=1000,
+        help="The max_history of the cached sampler with a bounded history. Default is 1000."
+    )
+
+    parser.add_argument(
+        "-s",
+        "--storage",
+        dest="storage",
+        type=str,
+        default=None,
+        help="The storage url of the benchmark study. Default is a temporary SQLite file."
+    )
+
+    return vars(parser.parse_args())
+
+
+def fill_study(storage: str, study_name: str, n_trials: int, n_params: int) -> None:
+
+    """
+    Adds completed trials with random parameters to the study until it holds n_trials.
+    """
+
+    study = optuna.create_study(study_name = study_name, storage = storage, load_if_exists = True)
+    n_existing = len(study.get_trials(deepcopy = False))
+    rng = np.random.RandomState(n_existing)
+    distributions = {f"x{i}": optuna.distributions.UniformDistribution(-1, 1) for i in range(n_params)}
+    for _ in range(n_trials - n_existing):
+        params = {name: rng.uniform(-1, 1) for name in distributions}
+        study.add_trial(optuna.trial.create_trial(
+            params = params,
+            distributions = distributions,
+            value = float(sum([v ** 2 for v in params.values()]))
+        ))
+
+
+def time_sampling(storage: str,
+                  study_name: str,
+                  sampler: optuna.samplers.BaseSampler,
+                  n_params: int,
+                  repeats: int) -> float:
+
+    """
+    Returns the mean number of seconds spent asking for a trial and suggesting its
+    parameters, after a first trial that loads the study into the worker. The
+    storage batches the writes to the running trial, as in run.py.
+    """
+
+    study = optuna.load_study(study_name = study_name, storage = batched_storage(storage), sampler = sampler)
+    seconds = []
+    for _ in range(repeats + 1):
+        start = time.time()
+        trial = study.ask()
+        for i in range(n_params):
+            trial.suggest_float(f"x{i}", -1, 1)
+        seconds.append(time.time() - start)
+        study.tell(trial, state = optuna.trial.TrialState.FAIL)
+    return float(np.mean(seconds[1:]))
+
+
+if __name__ == "__main__":
+
+    args_dict = args()
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+    root.addHandler(ch)
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+
+    storage = args_dict["storage"]
+    if storage is None:
+        storage = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    study_name = "sampler_cache_benchmark"
+
+    logging.info("n_trials stock_seconds cached_seconds speedup bounded_seconds speedup")
+    for n_trials in sorted(args_dict["n_trials"]):
+        fill_study(storage, study_name, n_trials, args_dict["n_params"])
+        stock = time_sampling(
+            storage, study_name, optuna.samplers.TPESampler(), 
+            args_dict["n_params"], args_dict["repeats"]
+        )
+        cached = time_sampling(
+            storage, study_name, CachedTrialsSampler(optuna.samplers.TPESampler()), 
+            args_dict["n_params"], args_dict["repeats"]
+        )
+        bounded = time_sampling(
+            storage, study_name, 
+            CachedTrialsSampler(optuna.samplers.TPESampler(), max_history = args_dict["max_history"]), 
+            args_dict["n_params"], args_dict["repeats"]
+        )
+        logging.info(
+            f"{n_trials} {stock:.3f} {cached:.3f} {stock / cached:.1f} {bounded:.3f} {stock / bounded:.1f}"
+        )
+    sys.exit()
@@ -0,0 +1,220 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import os
+import sys
+import time
+import optuna
+import logging
+import tempfile
+import numpy as np
+import multiprocessing
+from argparse import ArgumentParser
+from typing import Dict
+from aimlutils.echo.src.storage import load_storage
+from aimlutils.echo.src.engine import batched_storage
+
+
+def args():
+    parser = ArgumentParser(description=
+        "storage_contention.py: Time many local workers running trials against each storage backend"
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        type=int,
+        nargs="+",
+        default=[4, 16, 32],
+        help="The numbers of concurrent worker processes. Default is 4 16 32."
+    )
+
+    parser.add_argument(
+        "-t",
+        "--n_trials",
+        dest="n_trials",
+        type=int,
+        default=20,
+        help="The number of trials each worker runs. Default is 20."
+    )
+
+    parser.add_argument(
+        "-p",
+        "--n_params",
+        dest="n_params",
+        type=int,
+        default=5,
+        help="The number of parameters suggested in each trial. Default is 5."
+    )
+
+    parser.add_argument(
+        "-s",
+        "--n_steps",
+        dest="n_steps",
+        type=int,
+        default=10,
+        help="The number of intermediate values reported in each trial. Default is 10."
+    )
+
+    parser.add_argument(
+        "-f",
+        "--flush_interval",
+        dest="flush_interval",
+        type=float,
+        default=0,
+        help="The flush_interval of the workers (see run.py). Default is 0, which writes every report."
+    )
+
+    parser.add_argument(
+        "-d",
+        "--directory",
+        dest="directory",
+        type=str,
+        default=None,
+        help="Where the databases and journals are written, e.g. on the shared filesystem. Default is a temporary directory."
+    )
+
+    return vars(parser.parse_args())
+
+
+def backends(directory: str) -> Dict[str, Dict[str, object]]:
+
+    """
+    Returns the optuna sections (storage and storage_options) of the backends to compare.
+    """
+
+    configs = {
+        "sqlite": {
+            "storage": f"sqlite:///{os.path.join(directory, 'sqlite.db')}"
+        },
+        "sqlite_retry": {
+            "storage": f"sqlite:///{os.path.join(directory, 'sqlite_retry.db')}",
+            "storage_options": {"busy_timeout": 30, "max_retries": 5}
+        },
+        "sqlite_wal": {
+            "storage": f"sqlite:///{os.path.join(directory, 'sqlite_wal.db')}",
+            "storage_options": {"busy_timeout": 30, "max_retries": 5, "wal": True}
+        },
+        "journal": {
+            "storage": f"journal://{os.path.join(directory, 'journal.log')}"
+        }
+    }
+    return configs
+
+
+def run_worker(optuna_config: Dict[str, object],
+               study_name: str,
+               n_trials: int,
+               n_params: int,
+               n_steps: int,
+               flush_interval: float,
+               start: multiprocessing.Barrier,
+               queue: multiprocessing.Queue) -> None:
+
+    """
+    Loads the study and waits at the start barrier for the other workers. Then runs
+    n_trials trials that suggest n_params parameters and report n_steps intermediate
+    values, and puts the seconds of each finished trial and the number of trials
+    that failed with a storage error in the queue.
+    """
+
+    optuna.logging.set_verbosity(optuna.logging.ERROR)
+    seconds, errors = [], 0
+    try:
+        storage = batched_storage(load_storage(optuna_config), flush_interval)
+        study = optuna.load_study(
+            study_name = study_name, storage = storage, sampler = optuna.samplers.RandomSampler()
+        )
+    except Exception:
+        start.wait()
+        queue.put((seconds, n_trials))
+        return
+    start.wait()
+    for _ in range(n_trials):
+        trial_start = time.time()
+        try:
+            trial = study.ask()
+            x = [trial.suggest_float(f"x{i}", -1, 1) for i in range(n_params)]
+            for step in range(n_steps):
+                trial.report(float(sum([v ** 2 for v in x])) / (step + 1), step)
+            study.tell(trial, float(sum([v ** 2 for v in x])))
+            seconds.append(time.time() - trial_start)
+        except Exception:
+            errors += 1
+    queue.put((seconds, errors))
+
+
+def time_backend(optuna_config: Dict[str, object],
+                 n_workers: int,
+                 n_trials: int,
+                 n_params: int,
+                 n_steps: int,
+                 flush_interval: float) -> Dict[str, float]:
+
+    """
+    Runs n_workers worker processes against a new study in the backend, and returns the
+    wall time, the number of finished and failed trials, and the trial time percentiles.
+    The wall time starts once every worker has loaded the study.
+    """
+
+    study_name = f"contention_{n_workers}"
+    optuna.create_study(study_name = study_name, storage = load_storage(optuna_config))
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    barrier = context.Barrier(n_workers + 1)
+    workers = [
+        context.Process(
+            target = run_worker,
+            args = (optuna_config, study_name, n_trials, n_params, n_steps, flush_interval, barrier, queue)
+        ) for _ in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.time()
+    results = [queue.get() for _ in workers]
+    wall = time.time() - start
+    for worker in workers:
+        worker.join()
+
+    seconds = np.array([s for result in results for s in result[0]])
+    return {
+        "wall": wall,
+        "finished": len(seconds),
+        "errors": sum([result[1] for result in results]),
+        "p50": float(np.percentile(seconds, 50)) if len(seconds) else float("nan"),
+        "p95": float(np.percentile(seconds, 95)) if len(seconds) else float("nan")
+    }
+
+
+if __name__ == "__main__":
+
+    args_dict = args()
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    ch = logging.StreamHandler()
+    ch.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+    root.addHandler(ch)
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    # Only the trials that failed are reported, not each retry of the storage
+    logging.getLogger("aimlutils.echo.src.storage").setLevel(logging.ERROR)
+
+    directory = args_dict["directory"]
+    if directory is None:
+        directory = tempfile.mkdtemp()
+
+    logging.info("backend workers trials_per_second errors p50_seconds p95_seconds")
+    for name, optuna_config in backends(directory).items():
+        for n_workers in sorted(args_dict["workers"]):
+            result = time_backend(
+                optuna_config, n_workers, args_dict["n_trials"], args_dict["n_params"],
+                args_dict["n_steps"], args_dict["flush_interval"]
+            )
+            logging.info(
+                f'{name} {n_workers} {result["finished"] / result["wall"]:.1f} {result["errors"]} '
+                f'{result["p50"]:.3f} {result["p95"]:.3f}'
+            )
+    sys.exit()
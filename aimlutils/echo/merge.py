@@ -0,0 +1,89 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+import os
+import sys
+import yaml
+import logging
+from argparse import ArgumentParser
+from aimlutils.echo.src.results_store import merge_results
+
+
+def args():
+    parser = ArgumentParser(description=
+        "merge.py: Merge the per-worker results files of a hyperparameter study into one SQLite file"
+    )
+
+    parser.add_argument("hyperparameter", type=str, help=
+            "Path to the hyperparameter configuration, or the save_path directory of the study."
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        type=str,
+        default=None,
+        help="Path of the SQLite file to merge into. Default is save_path/results.db."
+    )
+
+    parser.add_argument(
+        "-r",
+        "--remove",
+        dest="remove",
+        action="store_true",
+        help="Delete the csv files once merged. Only use this when no workers are running."
+    )
+
+    parser.add_argument(
+        "-c",
+        "--csv",
+        dest="csv",
+        type=str,
+        default=None,
+        help="Also write all of the merged results to this csv file."
+    )
+
+    return vars(parser.parse_args())
+
+
+def main():
+
+    args_dict = args()
+    hyper_config = args_dict.pop("hyperparameter")
+
+    if os.path.isdir(hyper_config):
+        save_path = hyper_config
+    elif os.path.isfile(hyper_config):
+        with open(hyper_config) as f:
+            save_path = yaml.load(f, Loader=yaml.FullLoader)["optuna"]["save_path"]
+    else:
+        raise OSError(
+            f"Hyperparameter optimization config file {hyper_config} does not exist"
+        )
+
+    # Set up a logger
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(levelname)s:%(name)s:%(message)s')
+
+    # Stream output to stdout
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(formatter)
+    root.addHandler(ch)
+
+    store = merge_results(
+        save_path,
+        store_path = args_dict["output"],
+        remove = args_dict["remove"]
+    )
+
+    if args_dict["csv"] is not None:
+        store.to_pandas().to_csv(args_dict["csv"], index = None)
+        logging.info(f"Saved the merged results to {args_dict['csv']}")
+    store.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,10 +6,14 @@ import sys
 import yaml
 import optuna
 import logging
+import datetime
 import subprocess
 from argparse import ArgumentParser
-from aimlutils.echo.src.samplers import samplers
-from typing import Dict
+from aimlutils.echo.src.samplers import samplers, PartitionedGridSampler
+from aimlutils.echo.src.pruners import pruners
+from aimlutils.echo.src.local import launch_local_workers
+from aimlutils.echo.src.storage import load_storage
+from typing import Dict, List
 
 
 def args():
@@ -95,6 +99,20 @@ def args():
         default=False, 
         help="Path to the save directory"
     )   
+    parser.add_argument(
+        "--repair", 
+        dest="repair", 
+        type=str,
+        default="fail",
+        choices=["fail", "prune", "rebuild"],
+        help="How broken trials are repaired on reload: mark them failed (default) or pruned in place, or rebuild the whole study"
+    )
+    parser.add_argument(
+        "--dry_run", 
+        dest="dry_run", 
+        action="store_true",
+        help="Report the broken trials and how they would be repaired, then exit"
+    )
     parser.add_argument(
         "-c", 
         "--create_study", 
@@ -166,6 +184,194 @@ def fix_broken_study(_study: optuna.study.Study,
     return study_fixed, removed
 
 
+# The rows that repair_broken_study updates directly are those of the optuna 2.x schema
+rdb_repair_supported = int(optuna.__version__.split(".")[0]) == 2
+
+
+def repair_state(trial: optuna.trial.FrozenTrial, mode: str) -> optuna.trial.TrialState:
+    
+    """
+        Returns the state that a broken trial is repaired to (see repair_broken_study),
+        or None if mode is "rebuild".
+    """
+    
+    if mode == "rebuild":
+        return None
+    good_values = [v for v in trial.intermediate_values.values() if v is not None]
+    if mode == "prune" and len(good_values) > 0:
+        return optuna.trial.TrialState.PRUNED
+    return optuna.trial.TrialState.FAIL
+
+
+def broken_trials(_study: optuna.study.Study, mode: str = "rebuild") -> List[optuna.trial.FrozenTrial]:
+    
+    """
+        Returns the trials whose last reported intermediate value is None
+        (see fix_broken_study), skipping those that are already in the state
+        that mode repairs them to.
+    """
+    
+    _study = getattr(_study, "_study", _study) # multi-objective studies wrap a study
+    broken = []
+    for trial in _study.get_trials(deepcopy = False):
+        if len(trial.intermediate_values) == 0:
+            continue
+        step, intermediate_value = max(trial.intermediate_values.items())
+        if intermediate_value is None and trial.state != repair_state(trial, mode):
+            broken.append(trial)
+    return broken
+
+
+def repair_broken_study(_study: optuna.study.Study, 
+                        mode: str = "fail", 
+                        dry_run: bool = False) -> List[int]:
+    
+    """
+        Repairs the broken trials in place, so that the work done is proportional 
+        to the number of broken trials rather than to the size of the study.
+        
+        mode = "fail": the broken trials are marked as FAIL, which samplers and pruners ignore.
+        mode = "prune": the broken trials are marked as PRUNED, keeping their last good 
+            value. Trials without any good values are marked as FAIL. (A database 
+            storage cannot hold None intermediate values, so there are none to remove.)
+        
+        Trials that are already in that state are left alone, so a reload only 
+        repairs new broken trials.
+        
+        Running trials are updated through the storage. Finished trials can only be 
+        changed in a database (RDB) storage of optuna 2.x, where their rows are 
+        updated directly.
+        
+        Returns the numbers of the repaired trials. If dry_run is True, only reports them.
+    """
+    
+    _study = getattr(_study, "_study", _study)
+    storage = _study._storage
+    backend = getattr(storage, "_backend", storage)
+    is_rdb = isinstance(backend, optuna.storages.RDBStorage)
+    
+    repaired = []
+    for trial in broken_trials(_study, mode):
+        state = repair_state(trial, mode) or optuna.trial.TrialState.FAIL
+        
+        action = "removed by rebuilding the study" if mode == "rebuild" else state.name
+        logging.info(
+            f"Broken trial {trial.number} ({trial.state.name}, last step {trial.last_step}) -> {action}"
+        )
+        if dry_run:
+            repaired.append(trial.number)
+            continue
+        
+        if not trial.state.is_finished():
+            storage.set_trial_state(trial._trial_id, state)
+        elif is_rdb and rdb_repair_supported:
+            from optuna.storages._rdb import models
+            session = backend.scoped_session()
+            try:
+                update = {models.TrialModel.state: state}
+                if trial.datetime_complete is None:
+                    update[models.TrialModel.datetime_complete] = datetime.datetime.now()
+                session.query(models.TrialModel).filter(
+                    models.TrialModel.trial_id == trial._trial_id
+                ).update(update, synchronize_session = False)
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+        else:
+            logging.warning(
+                f"Trial {trial.number} has already finished and cannot be changed in this storage. Use --repair rebuild"
+            )
+            continue
+        repaired.append(trial.number)
+        
+    return repaired
+
+
+def use_job_array(hyper_config: Dict[str, str], 
+                  scheduler: str) -> bool:
+    
+    """
+        Returns True if the workers should be submitted as a single array job.
+        An array needs at least two workers (pbs refuses single-task arrays).
+    """
+    
+    config = hyper_config[scheduler]
+    return bool(config.get("array", False)) and int(config["jobs"]) > 1
+
+
+def submit_workers(hyper_config: Dict[str, str], 
+                   scheduler: str, 
+                   script_location: str) -> List[str]:
+    
+    """
+        Submits the workers to slurm (sbatch) or pbs (qsub) and returns their job ids.
+        
+        In array mode a single array job is submitted with one call to the scheduler, 
+        and the ids of the array tasks are derived from the returned job id. Otherwise 
+        one job is submitted per worker.
+        
+        Inputs: 
+            hyper_config: the hyperparameter configuration
+            scheduler: either "slurm" or "pbs"
+            script_location: path to the prepared launch script
+    """
+    
+    config = hyper_config[scheduler]
+    n_workers = int(config["jobs"])
+    command = "sbatch" if scheduler == "slurm" else "qsub"
+    name_option = "J" if scheduler == "slurm" else "N"
+    job_name = config["batch"][name_option] if name_option in config["batch"] else "echo_trial"
+    
+    def parse_job_id(stdout):
+        stdout = stdout.decode("utf-8").strip("\n")
+        return stdout.split(" ")[-1] if scheduler == "slurm" else stdout
+    
+    job_ids = []
+    if use_job_array(hyper_config, scheduler):
+        p = subprocess.Popen(
+            f"{command} -{name_option} {job_name} {script_location}",
+            shell=True,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE
+        )
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            raise OSError(
+                f"Submitting the {scheduler} array job failed: {stderr.decode('utf-8').strip()}"
+            )
+        array_id = parse_job_id(stdout)
+        for task in range(n_workers):
+            if scheduler == "slurm":
+                job_ids.append(f"{array_id}_{task}")
+            else: # qsub returns e.g. 1234[].server
+                job_ids.append(array_id.replace("[]", f"[{task}]"))
+        logging.info(
+            f"Submitted {scheduler} array job {array_id} with {n_workers} tasks"
+        )
+        return job_ids
+    
+    for worker in range(n_workers):
+        # Number the workers as an array job would, e.g. for the distributed sampler
+        if scheduler == "slurm":
+            env_option = f"--export=ALL,ECHO_WORKER_INDEX={worker}"
+        else:
+            env_option = f"-v ECHO_WORKER_INDEX={worker}"
+        w = subprocess.Popen(
+            f"{command} -{name_option} {job_name}_{worker} {env_option} {script_location}",
+            shell=True,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE
+        ).communicate()
+        job_ids.append(parse_job_id(w[0]))
+        logging.info(
+            f"Submitted {scheduler} batch job {worker + 1}/{n_workers} with id {job_ids[-1]}"
+        )
+    return job_ids
+
+
 def prepare_slurm_launch_script(hyper_config: str, 
                                 model_config: str):
     
@@ -174,6 +380,12 @@ def prepare_slurm_launch_script(hyper_config: str,
         f"#SBATCH -{arg} {val}" if len(arg) == 1 else f"#SBATCH --{arg}={val}" 
         for arg, val in hyper_config["slurm"]["batch"].items()
     ]
+    array = use_job_array(hyper_config, "slurm")
+    if array:
+        task_range = f'0-{int(hyper_config["slurm"]["jobs"]) - 1}'
+        if "array_limit" in hyper_config["slurm"]:
+            task_range += f'%{hyper_config["slurm"]["array_limit"]}'
+        slurm_options.append(f"#SBATCH --array={task_range}")
     if "bash" in hyper_config["slurm"]:
         if len(hyper_config["slurm"]["bash"]) > 0:
             for line in hyper_config["slurm"]["bash"]:
@@ -181,6 +393,8 @@ def prepare_slurm_launch_script(hyper_config: str,
     if "kernel" in hyper_config["slurm"]:
         if hyper_config["slurm"]["kernel"] is not None:
             slurm_options.append(f'{hyper_config["slurm"]["kernel"]}')
+    if array:
+        slurm_options.append("export ECHO_WORKER_INDEX=$SLURM_ARRAY_TASK_ID")
     import aimlutils.echo as opt
     aiml_path = os.path.join(
         os.path.abspath(opt.__file__).strip("__init__.py"), 
@@ -202,6 +416,9 @@ def prepare_pbs_launch_script(hyper_config: str,
             pbs_options.append(f"#PBS -{arg} {val}")
         else:
             pbs_options.append(f"#PBS --{arg}={val}")     
+    array = use_job_array(hyper_config, "pbs")
+    if array:
+        pbs_options.append(f'#PBS -J 0-{int(hyper_config["pbs"]["jobs"]) - 1}')
     if "bash" in hyper_config["pbs"]:
         if len(hyper_config["pbs"]["bash"]) > 0:
             for line in hyper_config["pbs"]["bash"]:
@@ -209,6 +426,8 @@ def prepare_pbs_launch_script(hyper_config: str,
     if "kernel" in hyper_config["pbs"]:
         if hyper_config["pbs"]["kernel"] is not None:
             pbs_options.append(f'{hyper_config["pbs"]["kernel"]}')
+    if array:
+        pbs_options.append("export ECHO_WORKER_INDEX=$PBS_ARRAY_INDEX")
     import aimlutils.echo as opt
     aiml_path = os.path.join(
         os.path.abspath(opt.__file__).strip("__init__.py"), 
@@ -313,7 +532,8 @@ if __name__ == "__main__":
     study_name = hyper_config["optuna"]["study_name"]
     #path_to_study = os.path.join(hyper_config["optuna"]["save_path"], name)
     #storage = f"sqlite:///{path_to_study}"
-    storage = hyper_config["optuna"]["storage"]
+    storage_url = hyper_config["optuna"]["storage"]
+    storage = load_storage(hyper_config["optuna"])
     direction = hyper_config["optuna"]["direction"]
     single_objective = isinstance(direction, str)
     
@@ -324,7 +544,13 @@ if __name__ == "__main__":
         else: # multi-objective equivalent of TPESampler
             sampler = optuna.multi_objective.samplers.MOTPEMultiObjectiveSampler()
     else:
-        sampler = samplers(hyper_config["optuna"]["sampler"])
+        sampler = samplers(dict(hyper_config["optuna"]["sampler"]))
+        
+    # Initialize the pruner
+    if "pruner" in hyper_config["optuna"]:
+        pruner = pruners(dict(hyper_config["optuna"]["pruner"]))
+    else:
+        pruner = optuna.pruners.MedianPruner()
 
     # Initiate a study for the first time
     if not reload_study:
@@ -356,7 +582,7 @@ if __name__ == "__main__":
         
         except:
             if args_dict["override"]:
-                message = f"Removing the study_name {study_name} that exists in storage {storage}."
+                message = f"Removing the study_name {study_name} that exists in storage {storage_url}."
                 optuna.delete_study(
                     study_name = study_name,
                     storage = storage,
@@ -365,7 +591,7 @@ if __name__ == "__main__":
             )
             else:
                 message = f"The study {study_name} already exists in storage and reload was False."
-                message += f" Delete it from {storage}, and try again or rerun this script"
+                message += f" Delete it from {storage_url}, and try again or rerun this script"
                 message += f" with the flag: --override 1"
                 raise OSError(message)
                 
@@ -375,7 +601,8 @@ if __name__ == "__main__":
                 study_name = study_name,
                 storage = storage,
                 direction = direction,
-                sampler = sampler
+                sampler = sampler,
+                pruner = pruner
             )
         else:
             create_study = optuna.multi_objective.study.create_study(
@@ -397,7 +624,8 @@ if __name__ == "__main__":
             study = optuna.load_study(
                 study_name = study_name,
                 storage = storage, 
-                sampler = sampler
+                sampler = sampler,
+                pruner = pruner
             )
         else:
             study = optuna.multi_objective.study.load_study(
@@ -405,7 +633,10 @@ if __name__ == "__main__":
                 storage = storage, 
                 sampler = sampler
             )
-        study, removed = fix_broken_study(study, study_name, storage, direction, sampler)
+        if args_dict["repair"] == "rebuild" and not args_dict["dry_run"]:
+            study, removed = fix_broken_study(study, study_name, storage, direction, sampler)
+        else:
+            removed = repair_broken_study(study, args_dict["repair"], args_dict["dry_run"])
         
         if len(removed):
             logging.info(
@@ -414,13 +645,34 @@ if __name__ == "__main__":
         else:
             logging.info("All trials check out!")
             
+        if args_dict["dry_run"]:
+            logging.info("Dry run: the study was not changed and no workers were submitted. Exiting.")
+            sys.exit()
+        
+    # Queue the cells of a partitioned grid, for the workers to claim one at a time
+    if isinstance(sampler, PartitionedGridSampler) and sampler.partition == "claim":
+        n_queued = sampler.enqueue_grid(study if reload_study else create_study)
+        logging.info(f"Queued {n_queued} of {len(sampler._all_grids)} grid cells")
+            
         
     # Override to create the database but skip submitting jobs. 
     create_db_only = True if args_dict["create_study"] else False
     
     # Stop here if arg is defined -- intention is that you manually run run.py for debugging purposes
     if create_db_only:
-        logging.info(f"Created study {study_name} located at {storage}. Exiting.")
+        logging.info(f"Created study {study_name} located at {storage_url}. Exiting.")
+        sys.exit()
+        
+    ###############
+    #
+    # LOCAL SUPPORT
+    #
+    ###############
+    
+    # Run the workers on this machine instead of submitting them to a scheduler
+    if "local" in hyper_config:
+        exit_codes = launch_local_workers(hyper_config, sys.argv[1], sys.argv[2])
+        logging.info(f"All local workers have exited with codes {exit_codes}")
         sys.exit()
         
     ###############
@@ -441,23 +693,7 @@ if __name__ == "__main__":
                 fid.write(f"{line}\n")
 
         # Launch the slurm jobs
-        job_ids = []
-        name_condition = "J" in hyper_config["slurm"]["batch"]
-        slurm_job_name = hyper_config["slurm"]["batch"]["J"] if name_condition else "echo_trial"
-        n_workers = hyper_config["slurm"]["jobs"]
-        for worker in range(n_workers):
-            w = subprocess.Popen(
-                f"sbatch -J {slurm_job_name}_{worker} {script_location}",
-                shell=True,
-                stdout = subprocess.PIPE,
-                stderr = subprocess.PIPE
-            ).communicate()
-            job_ids.append(
-                w[0].decode("utf-8").strip("\n").split(" ")[-1]
-            )
-            logging.info(
-                f"Submitted slurm batch job {worker + 1}/{n_workers} with id {job_ids[-1]}"
-            )
+        job_ids = submit_workers(hyper_config, "slurm", script_location)
 
         # Write the job ids to file for reference
         with open(os.path.join(script_path, "slurm_job_ids.txt"), "w") as fid:
@@ -480,24 +716,8 @@ if __name__ == "__main__":
             for line in launch_script:
                 fid.write(f"{line}\n")
 
-        # Launch the slurm jobs
-        job_ids = []
-        name_condition = "J" in hyper_config["pbs"]["batch"]
-        slurm_job_name = hyper_config["pbs"]["batch"]["N"] if name_condition else "echo_trial"
-        n_workers = hyper_config["pbs"]["jobs"]
-        for worker in range(n_workers):
-            w = subprocess.Popen(
-                f"qsub -N {slurm_job_name}_{worker} {script_location}",
-                shell=True,
-                stdout = subprocess.PIPE,
-                stderr = subprocess.PIPE
-            ).communicate()
-            job_ids.append(
-                w[0].decode("utf-8").strip("\n")
-            )
-            logging.info(
-                f"Submitted pbs batch job {worker + 1}/{n_workers} with id {job_ids[-1]}"
-            )
+        # Launch the pbs jobs
+        job_ids = submit_workers(hyper_config, "pbs", script_location)
 
         # Write the job ids to file for reference
         with open(os.path.join(script_path, "pbs_job_ids.txt"), "w") as fid:
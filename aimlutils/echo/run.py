@@ -1,9 +1,17 @@
 import warnings
 warnings.filterwarnings("ignore")
 
-from aimlutils.echo.src.samplers import samplers
+from aimlutils.echo.src.samplers import samplers, PartitionedGridSampler
+from aimlutils.echo.src.pruners import pruners
+from aimlutils.echo.src.walltime import TrialTimeout, TrialTerminated, WallTimeExceeded, completed_trial_durations, estimate_run_time, trial_timeout, terminate_trial_on_sigterm
+from aimlutils.echo.src.engine import AskTellWorker, batched_storage
+from aimlutils.echo.src.storage import load_storage
+from aimlutils.echo.src.instrument import stats_path
+from aimlutils.echo.src.heartbeat import reap_stale_trials, enqueue_retry
+from aimlutils.echo.src.resume import latest_trial, checkpoint_key
 from aimlutils.utils.gpu import gpu_report
 import importlib.machinery
+import multiprocessing
 import pandas as pd
 import numpy as np
 import logging
@@ -19,6 +27,8 @@ start_the_clock = time.time()
 
 def get_sec(time_str):
     """Get Seconds from time."""
+    if isinstance(time_str, (int, float)):
+        return float(time_str)
     h, m, s = time_str.split(':')
     return int(h) * 3600 + int(m) * 60 + int(s)
 
@@ -140,7 +150,8 @@ else:
     metric = str(model_config["optuna"]["metric"])
 logging.info(f"Using metric {metric}")
 
-# Get list of devices and initialize the Objective class
+# Get list of devices. One worker process will be launched per device.
+workers_per_node = int(model_config["optuna"].get("workers_per_node", 0))
 if bool(model_config["optuna"]["gpu"]):
     try:
         gpu_report = sorted(
@@ -148,16 +159,23 @@ if bool(model_config["optuna"]["gpu"]):
             key = lambda x: x[1], 
             reverse = True
         )
-        device = gpu_report[0][0]
+        devices = [device for device, free_memory in gpu_report]
     except:
         logging.warning(
             "The gpu is not responding to a call from nvidia-smi.\
             Setting gpu device = 0, but this may fail."
         )
-        device = 0
+        devices = [0]
+    if workers_per_node > 0:
+        devices = devices[:workers_per_node]
 else:
-    device = 'cpu'
-logging.info(f"Using device {device}")
+    devices = ['cpu'] * max(1, workers_per_node)
+    
+# A supervisor (e.g. the local launcher) may assign this worker a single device
+if "ECHO_DEVICE" in os.environ:
+    device = os.environ["ECHO_DEVICE"]
+    devices = [int(device) if device.isdigit() else device]
+logging.info(f"Using devices {devices}")
 
 ################################################################
 
@@ -178,38 +196,9 @@ reload_study = bool(model_config["optuna"]["reload"])
 # Identify the storage location
 storage = model_config["optuna"]["storage"] #f"sqlite:///{cached_study}"
 
-# Initialize the sampler
-if "sampler" not in hyper_config["optuna"]:
-    if single_objective: # single-objective
-        sampler = optuna.samplers.TPESampler()
-    else: # multi-objective equivalent of TPESampler
-        sampler = optuna.multi_objective.samplers.MOTPEMultiObjectiveSampler()
-else:
-    sampler = samplers(hyper_config["optuna"]["sampler"])
-
-# Load or initiate study
-if single_objective:
-    study = optuna.create_study(study_name=study_name,
-                                storage=storage,
-                                sampler=sampler,
-                                direction=direction,
-                                load_if_exists=True)
-else:
-    study = optuna.multi_objective.study.create_study(
-        study_name=study_name,
-        storage=storage,
-        sampler=sampler,
-        directions=direction,
-        load_if_exists=True
-    )
-logging.info(f"Loaded study {study_name} located at {storage}")
-
-# Initialize objective function
-objective = Objective(model_config, metric, device)
-
 # Optimize it
 logging.info(
-    f'Running optimization for {model_config["optuna"]["n_trials"]} trials'
+    f'Running optimization for {model_config["optuna"]["n_trials"]} trials per worker'
 )
     
 # Get the cluster job wall-time
@@ -224,57 +213,245 @@ elif "pbs" in hyper_config:
     if wall_time is False:
         logging.warning("Could not process the walltime for run.py. Assuming 12 hours.")
         wall_time = "12:00:00"
-wall_time_secs = get_sec(wall_time)
-
-logging.info(
-    f"This script will run for a fraction of the wall-time of {wall_time} and try to die without error"
-)
+elif "local" in hyper_config:
+    wall_time = hyper_config["local"].get("t", None)
+else:
+    wall_time = None
+wall_time_secs = get_sec(wall_time) if wall_time else None
 
-run_times = []
-estimated_run_time = wall_time_secs
+# The clock starts after the imports, so stop some time before the scheduler kills the job
+if wall_time_secs is not None:
+    if "wall_time_margin" in model_config["optuna"]:
+        wall_time_margin = get_sec(model_config["optuna"]["wall_time_margin"])
+    else:
+        wall_time_margin = min(300.0, 0.1 * wall_time_secs)
+    if wall_time_margin >= wall_time_secs:
+        raise OSError(
+            f"The wall_time_margin of {wall_time_margin} seconds must be shorter than the wall-time of {wall_time_secs} seconds"
+        )
 
-# study.optimize(
-#     objective, 
-#     n_trials = int(model_config["optuna"]["n_trials"]), 
-#     timeout = estimated_run_time,
-#     catch = (ValueError,)
-# )
+if wall_time_secs is not None:
+    logging.info(
+        f"This script will run for a fraction of the wall-time of {wall_time} and try to die without error"
+    )
+else:
+    logging.info("No wall-time was supplied, this script will run until n_trials have been attempted")
 
-# Testing out way to stop running trials if too close to wall-time. 
-# Update to computing the mean of the run times of all completed trials in the database.
 
-for iteration in range(int(model_config["optuna"]["n_trials"])):
+def worker(worker_index, device):
     
-    try:
-        start_time = time.time()
-        study.optimize(
-            objective, 
-            n_trials = 1, 
-            timeout = estimated_run_time,
-            #catch = (ValueError,) 
+    """
+        Runs trials on a single device until n_trials have been attempted
+        or the wall-time is about to run out. When several workers are
+        launched on a node, each one is pinned to its own device and
+        loads its own copy of the study from the shared storage.
+        
+        Returns 0 on a clean exit and 1 if the worker died due to an error.
+    """
+    
+    # Array tasks (and the local launcher) number the nodes, and each node its workers.
+    # Logs and stats use the number of the worker across all nodes.
+    node_index = int(os.environ.get("ECHO_WORKER_INDEX", 0))
+    worker_index = node_index * len(devices) + worker_index
+    
+    if device != "cpu" and len(devices) > 1:
+        visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+        visible = visible.split(",") if visible else []
+        pinned = visible[device] if device < len(visible) else str(device)
+        os.environ["CUDA_VISIBLE_DEVICES"] = pinned
+        logging.info(f"Worker {worker_index} pinned to gpu {pinned}")
+        device = 0
+    
+    # Initialize the sampler
+    if "sampler" not in hyper_config["optuna"]:
+        if single_objective: # single-objective
+            sampler = optuna.samplers.TPESampler()
+        else: # multi-objective equivalent of TPESampler
+            sampler = optuna.multi_objective.samplers.MOTPEMultiObjectiveSampler()
+    else:
+        sampler = samplers(
+            dict(hyper_config["optuna"]["sampler"]), 
+            worker_index = worker_index
         )
-        end_time = time.time()
-        run_times.append(end_time - start_time)
         
-    except KeyboardInterrupt:
-        logging.warning(
-                f"Recieved signal to die from keyboard. Exiting."
-            )
-        break
+    # Initialize the pruner (multi-objective studies do not support pruning)
+    if "pruner" in hyper_config["optuna"]:
+        pruner = pruners(dict(hyper_config["optuna"]["pruner"]))
+    else:
+        pruner = optuna.pruners.MedianPruner()
+
+    # Optionally time every call this worker makes to the database (or journal),
+    # below the cache and the batching of writes
+    instrument = bool(model_config["optuna"].get("instrument_storage", False))
+    stats_file = None
+    if instrument:
+        stats_dir = os.path.join(model_config["optuna"]["save_path"], "storage_stats")
+        os.makedirs(stats_dir, exist_ok = True)
+        stats_file = stats_path(stats_dir, worker_index)
+
+    # Load the storage once per worker (database connections are not shared between
+    # processes). Writes to running trials are sent in batches.
+    flush_interval = float(model_config["optuna"].get("flush_interval", 30))
+    worker_storage = batched_storage(load_storage(model_config["optuna"], instrument), flush_interval)
+    timed_storage = getattr(worker_storage, "_backend", worker_storage)
+
+    # Load or initiate study
+    if single_objective:
+        study = optuna.create_study(study_name=study_name,
+                                    storage=worker_storage,
+                                    sampler=sampler,
+                                    pruner=pruner,
+                                    direction=direction,
+                                    load_if_exists=True)
+    else:
+        study = optuna.multi_objective.study.create_study(
+            study_name=study_name,
+            storage=worker_storage,
+            sampler=sampler,
+            directions=direction,
+            load_if_exists=True
+        )
+    logging.info(f"Worker {worker_index} loaded study {study_name} located at {storage}")
+
+    # Initialize objective function
+    objective = Objective(model_config, metric, device)
     
-    except Exception as E:
-        logging.warning(
-                f"Dying early due to error {E}"
-            )
-        break
+    # Options for predicting trial run times and limiting them
+    runtime = model_config["optuna"].get("runtime", {})
+    n_sigma = float(runtime.get("n_sigma", 2.0))
+    min_trials = int(runtime.get("min_trials", 3))
+    trial_time_limit = get_sec(runtime["trial_timeout"]) if "trial_timeout" in runtime else None
+    deadline = start_the_clock + wall_time_secs - wall_time_margin if wall_time_secs is not None else None
+    objective.deadline = deadline
     
-    if len(run_times) > 1:
-        average_run_time = np.mean(run_times)
-        sigma_run_time = np.std(run_times) if len(run_times) > 2 else 0.0
-        estimated_run_time = average_run_time + 2 * sigma_run_time
-        time_left = wall_time_secs - (time.time() - start_the_clock)
-        if time_left < estimated_run_time:
-            logging.warning(
-                f"Dying early as estimated run-time exceeds the time remaining on this node."
+    # Run the trials with ask/tell on the same study object, timing each phase
+    def log_phase(phase, seconds, trial):
+        logging.debug(f"Worker {worker_index} trial {trial.number}: {phase} took {seconds:.3f} s")
+    def save_storage_stats(phase = "tell", seconds = None, trial = None):
+        # Saved after every trial, as the worker may be killed at the wall-time
+        if stats_file is not None and phase == "tell":
+            phases = {_phase: float(np.sum(_seconds)) for _phase, _seconds in engine.timings.items()}
+            timed_storage.dump(stats_file, phases)
+    engine = AskTellWorker(study, objective, hooks = [log_phase, save_storage_stats])
+
+    # Options for reclaiming the trials of killed workers
+    heartbeat = model_config["optuna"].get("heartbeat", {})
+
+    run_times = []
+
+    for iteration in range(int(model_config["optuna"]["n_trials"])):
+        
+        # Fail (and optionally re-enqueue) trials whose workers stopped sending heartbeats
+        if "interval" in heartbeat:
+            reap_stale_trials(
+                study, 
+                grace_period = float(heartbeat.get("grace_period", 10 * heartbeat["interval"])),
+                retry = bool(heartbeat.get("retry", False)),
+                max_retries = int(heartbeat.get("max_retries", 1))
+            )
+        
+        # Stop once the sampler (e.g. a GridSampler whose grid is used up) stopped the study
+        if engine.stopped:
+            logging.info(f"Worker {worker_index} is stopping as the study was stopped.")
+            break
+
+        # Stop once a partitioned grid has no cells left for this worker
+        if isinstance(sampler, PartitionedGridSampler) and sampler.exhausted(study):
+            logging.info(f"Worker {worker_index} is stopping as the grid is exhausted.")
+            break
+        
+        # Stop before starting a trial that is not expected to finish before the wall-time.
+        # The estimate uses all of the completed trials in the study, falling back to the 
+        # trials run by this worker while the study is still young.
+        time_limit = trial_time_limit
+        if deadline is not None:
+            time_left = deadline - time.time()
+            estimated_run_time = estimate_run_time(
+                completed_trial_durations(study), n_sigma, min_trials
             )
-            break
\ No newline at end of file
+            if estimated_run_time is None:
+                estimated_run_time = estimate_run_time(run_times, n_sigma, min_trials = 2)
+            if time_left <= 0 or (estimated_run_time is not None and time_left < estimated_run_time):
+                logging.warning(
+                    "Dying early as estimated run-time exceeds the time remaining on this node."
+                )
+                break
+            time_limit = time_left if time_limit is None else min(time_limit, time_left)
+
+        try:
+            start_time = time.time()
+            with trial_timeout(time_limit), terminate_trial_on_sigterm():
+                engine.run_trial()
+            end_time = time.time()
+            run_times.append(end_time - start_time)
+            
+        except WallTimeExceeded as E:
+            logging.warning(f"Dying early: {E}")
+            break
+            
+        except TrialTimeout as E:
+            logging.warning(f"Stopped the current trial: {E}")
+            # Let a later worker resume the trial from its last checkpoint
+            interrupted = latest_trial(engine.trial)
+            if checkpoint_key in interrupted.system_attrs:
+                enqueue_retry(study, interrupted)
+                logging.info(
+                    f"Trial {interrupted.number} will be resumed from checkpoint {interrupted.system_attrs[checkpoint_key]}"
+                )
+            # The scheduler is about to kill the job
+            if isinstance(E, TrialTerminated):
+                break
+            continue
+
+        except KeyboardInterrupt:
+            logging.warning(
+                    "Recieved signal to die from keyboard. Exiting."
+                )
+            break
+
+        except Exception as E:
+            logging.warning(
+                    f"Dying early due to error {E}"
+                )
+            save_storage_stats()
+            return 1
+        
+    for phase, seconds in engine.timings.items():
+        logging.info(
+            f"Worker {worker_index} spent {np.sum(seconds):.1f} s in {phase} ({np.mean(seconds):.3f} s per trial)"
+        )
+    if stats_file is not None:
+        save_storage_stats()
+        storage_seconds = sum([s["total"] for s in timed_storage.stats()["methods"].values()])
+        logging.info(
+            f"Worker {worker_index} spent {storage_seconds:.1f} s in storage calls, saved to {stats_file}"
+        )
+    return 0
+
+
+def worker_process(worker_index, device):
+    sys.exit(worker(worker_index, device))
+
+
+if len(devices) == 1:
+    sys.exit(worker(0, devices[0]))
+else:
+    # Fork so that the workers inherit the loaded configuration and objective class
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target = worker_process, args = (worker_index, device))
+        for worker_index, device in enumerate(devices)
+    ]
+    for process in processes:
+        process.start()
+    logging.info(f"Launched {len(processes)} workers on this node")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        logging.warning(
+            "Recieved signal to die from keyboard. Stopping the workers."
+        )
+        for process in processes:
+            process.terminate()
+    sys.exit(int(any([process.exitcode != 0 for process in processes])))
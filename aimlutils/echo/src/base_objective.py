@@ -2,9 +2,11 @@ import warnings
 warnings.filterwarnings("ignore")
 
 from aimlutils.echo.src.trial_suggest import trial_suggest_loader
-from collections import defaultdict
-import copy, os, sys, random
-import pandas as pd 
+from aimlutils.echo.src.walltime import WallTimeExceeded, completed_trial_durations, estimate_run_time
+from aimlutils.echo.src.heartbeat import Heartbeat
+from aimlutils.echo.src import resume, duplicates
+from aimlutils.utils.writers import CSVWriter
+import copy, os, sys, random, time
 import logging
 import optuna
 
@@ -27,7 +29,9 @@ class BaseObjective:
         self.metric = metric
         self.device = f"cuda:{device}" if device != "cpu" else "cpu"
         
-        self.results = defaultdict(list)
+        # Unix time at which the worker will be killed (set by run.py)
+        self.deadline = None
+        
         save_path = config["optuna"]["save_path"]
         self.results_fn = os.path.join(save_path, f"hyper_opt_{random.randint(0, 1e5)}.csv")
         while os.path.isfile(self.results_fn):
@@ -36,6 +40,7 @@ class BaseObjective:
             
         logger.info(f"Initialized an objective to be optimized with metric {metric}")
         logger.info(f"Using device {device}")
+        self.writer = CSVWriter(self.results_fn)
         logger.info(f"Saving study/trial results to local file {self.results_fn}")
     
     def update_config(self, trial):
@@ -83,21 +88,19 @@ class BaseObjective:
                         "You must return the metric result to the hyperparameter optimizer"
                     )
         
-        # Save the hyperparameters used in the trial
-        self.results["trial"].append(trial.number)
-        for param, value in trial.params.items():
-            self.results[param].append(value)
-        
-        # Save the metric and "other metrics"
-        for metric, value in results_dict.items():
-            self.results[metric].append(value)
+        # Save the hyperparameters used in the trial, the metric and "other metrics"
+        row = {"trial": trial.number}
+        row.update(trial.params)
+        row.update(results_dict)
+            
+        # Let the other workers match this trial against theirs
+        duplicates.record_hash(trial)
             
         # Save pruning boolean
-        self.results["pruned"] = int(trial.should_prune())
-        #self.results["complete"] = int(trial.state == optuna.trial.TrialState.COMPLETE)
+        row["pruned"] = int(trial.should_prune())
         
-        # Save the df of results to disk
-        pd.DataFrame.from_dict(self.results).to_csv(self.results_fn)
+        # Append the row to the results on disk
+        self.writer.write(row)
         
         logger.info(
             f"Saving trial {trial.number} results to local file {self.results_fn}"
@@ -106,21 +109,111 @@ class BaseObjective:
         if single_objective:
             return results_dict[self.metric]
         else:
-            return [result[metric] for metric in self.metric]
+            return [results_dict[metric] for metric in self.metric]
     
     def __call__(self, trial):
         
         # Automatically update the config, when possible
         conf = self.update_config(trial)
         
+        # Return the result of an identical completed trial instead of training again
+        settings = self.config["optuna"].get("duplicates", {})
+        if settings.get("skip", False):
+            cached = self.cached_result(
+                trial, inherit = settings.get("inherit_intermediate_values", True)
+            )
+            if cached is not None:
+                # Save a row for the trial, as if it had been trained
+                metrics = [self.metric] if isinstance(self.metric, str) else self.metric
+                values = [cached] if isinstance(self.metric, str) else cached
+                results_dict = dict(zip(metrics, values))
+                _trial = getattr(trial, "_trial", trial)
+                results_dict["duplicate_of"] = _trial.system_attrs[duplicates.duplicate_of_key]
+                return self.save(trial, results_dict)
+        
+        # Hand the parameters back to the study if the trial cannot finish in time
+        if self.deadline is not None:
+            self.check_wall_time(trial)
+        
         # Train the model
         logger.info(
             f"Beginning to train the model using the latest parameters from optuna"
         )
         
-        result = self.train(trial, conf)
+        # Let the other workers know that this trial is alive while it trains
+        interval = self.config["optuna"].get("heartbeat", {}).get("interval", None)
+        with Heartbeat(trial, interval):
+            result = self.train(trial, conf)
         
         return self.save(trial, result)
     
+    def cached_result(self, trial, inherit = True):
+        
+        # Parameters suggested inside train are not known yet, so the trial cannot be matched
+        names = [
+            update["settings"]["name"] for update in self.config["optuna"]["parameters"].values()
+        ]
+        _trial = getattr(trial, "_trial", trial)
+        missing = [name for name in names if name not in _trial.params]
+        if len(missing):
+            logger.debug(f"Not checking trial {trial.number} for duplicates as {missing} are suggested in train")
+            return None
+        
+        duplicates.record_hash(trial)
+        duplicate = duplicates.find_duplicate(trial)
+        if duplicate is None:
+            return None
+        
+        n_objectives = 1 if isinstance(self.metric, str) else len(self.metric)
+        if inherit:
+            duplicates.inherit_intermediate_values(trial, duplicate, n_objectives)
+        _trial.set_system_attr(duplicates.duplicate_of_key, duplicate.number)
+        logger.info(
+            f"Trial {trial.number} has the same parameters as completed trial {duplicate.number}. Reusing its result"
+        )
+        return duplicates.cached_values(duplicate, n_objectives)
+    
+    def checkpoint_path(self, trial, name = "checkpoint.pt"):
+        
+        # A checkpoint directory per trial, so that workers do not overwrite each other
+        path = os.path.join(
+            self.config["optuna"]["save_path"], "checkpoints", f"trial_{trial.number}"
+        )
+        os.makedirs(path, exist_ok = True)
+        return os.path.join(path, name)
+    
+    def record_checkpoint(self, trial, path, step):
+        
+        # Lets a later worker resume this trial from path if it gets interrupted
+        resume.record_checkpoint(trial, path, step)
+        
+    def resume_state(self, trial):
+        
+        # Checkpoint path and last step if this trial continues an interrupted trial, else None
+        return resume.resume_state(trial)
+    
+    def check_wall_time(self, trial):
+        
+        runtime = self.config["optuna"].get("runtime", {})
+        _trial = getattr(trial, "_trial", trial) # multi-objective trials wrap a trial
+        
+        durations = completed_trial_durations(
+            _trial.study, 
+            params = _trial.params, 
+            condition_on = runtime.get("condition_on", None)
+        )
+        estimated_run_time = estimate_run_time(
+            durations, 
+            n_sigma = float(runtime.get("n_sigma", 2.0)), 
+            min_trials = int(runtime.get("min_trials", 3))
+        )
+        time_left = self.deadline - time.time()
+        
+        if estimated_run_time is not None and estimated_run_time > time_left:
+            # The engine puts the trial back in the queue (see AskTellWorker)
+            raise WallTimeExceeded(
+                f"Trial {trial.number} is expected to take {estimated_run_time:.0f} seconds but only {time_left:.0f} remain"
+            )
+    
     def train(self, trial, conf):
         raise NotImplementedError
\ No newline at end of file
@@ -0,0 +1,94 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from typing import Dict, List, Union
+import hashlib
+import logging
+import optuna
+import json
+
+
+logger = logging.getLogger(__name__)
+
+
+params_hash_key = "echo:params_hash"
+duplicate_of_key = "echo:duplicate_of"
+
+
+def params_hash(params: Dict[str, object]) -> str:
+
+    """
+    Returns a hash of the parameters of a trial that does not depend on the order
+    in which they were suggested.
+    """
+
+    dump = json.dumps(params, sort_keys = True, default = str)
+    return hashlib.sha1(dump.encode("utf-8")).hexdigest()
+
+
+def record_hash(trial: optuna.trial.Trial) -> str:
+
+    """
+    Stores the hash of the parameters of trial in its system attributes, where
+    the other workers can match it without hashing every trial again.
+    """
+
+    trial = getattr(trial, "_trial", trial) # multi-objective trials wrap a trial
+    digest = params_hash(trial.params)
+    trial.set_system_attr(params_hash_key, digest)
+    return digest
+
+
+def find_duplicate(trial: optuna.trial.Trial) -> optuna.trial.FrozenTrial:
+
+    """
+    Returns the earliest completed trial of the study with exactly the same
+    parameters as trial, or None if there is no such trial.
+    """
+
+    trial = getattr(trial, "_trial", trial)
+    digest = params_hash(trial.params)
+    completed = trial.study._storage.get_all_trials(
+        trial.study._study_id, deepcopy = False, states = (optuna.trial.TrialState.COMPLETE,)
+    )
+    for t in completed:
+        if t.number == trial.number:
+            continue
+        # Trials finished before hashes were recorded are hashed here
+        other = t.system_attrs.get(params_hash_key, None) or params_hash(t.params)
+        if other == digest and t.params == trial.params: # guards against hash collisions
+            return t
+    return None
+
+
+def cached_values(trial: optuna.trial.FrozenTrial,
+                  n_objectives: int = 1) -> Union[float, List[float]]:
+
+    """
+    Returns the objective value(s) of a completed trial. Multi-objective studies
+    store the values as the first n_objectives intermediate values.
+    """
+
+    if n_objectives == 1:
+        return trial.value
+    return [trial.intermediate_values.get(i) for i in range(n_objectives)]
+
+
+def inherit_intermediate_values(trial: optuna.trial.Trial,
+                                duplicate: optuna.trial.FrozenTrial,
+                                n_objectives: int = 1) -> None:
+
+    """
+    Copies the intermediate values of duplicate to trial, so that the pruners
+    compare the later trials against a full learning curve.
+    """
+
+    _trial = getattr(trial, "_trial", trial)
+    # Skip the steps that hold the complete values of a multi-objective trial
+    first_step = 0 if n_objectives == 1 else n_objectives
+    # e.g. the steps already inherited from an interrupted trial
+    reported = _trial.study._storage.get_trial(_trial._trial_id).intermediate_values
+    for step, value in sorted(duplicate.intermediate_values.items()):
+        if step < first_step or value is None or step in reported:
+            continue
+        _trial.report(value, step)
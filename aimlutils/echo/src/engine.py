@@ -0,0 +1,201 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from aimlutils.echo.src.walltime import WallTimeExceeded
+from aimlutils.echo.src.heartbeat import worker_key, worker_name
+from optuna.storages._cached_storage import _CachedStorage
+from collections import defaultdict
+from typing import Callable, List, Union
+import logging
+import optuna
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchedStorage(_CachedStorage):
+
+    """
+    A cached RDB storage that holds back the writes a worker makes to its own
+    running trial (parameters, intermediate values, user and system attributes)
+    and sends them to the database in a single update every flush_interval
+    seconds, and when the trial finishes.
+
+    The worker itself (e.g. the pruner) always sees its latest writes through
+    the cache; other workers see them with a delay of at most flush_interval.
+    """
+
+    def __init__(self, backend: optuna.storages.RDBStorage, flush_interval: float = 30.0):
+        super().__init__(backend)
+        self.flush_interval = flush_interval
+        self._last_flush = {}
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._last_flush = {}
+
+    def create_new_trial(self, study_id, template_trial = None):
+        trial_id = super().create_new_trial(study_id, template_trial)
+        self._last_flush[trial_id] = time.time()
+        return trial_id
+
+    def _flush_trial(self, trial_id: int) -> bool:
+        if trial_id in self._trial_id_to_study_id_and_number:
+            study_id, number = self._trial_id_to_study_id_and_number[trial_id]
+            updates = self._studies[study_id].updates.get(number, None)
+            finishing = updates is not None and updates.state is not None
+            recently_flushed = (time.time() - self._last_flush.get(trial_id, 0)) < self.flush_interval
+            if recently_flushed and not finishing:
+                return True
+        self._last_flush[trial_id] = time.time()
+        return super()._flush_trial(trial_id)
+
+    def flush(self, trial_id: int) -> bool:
+        """Sends the held back writes of a trial to the database now."""
+        with self._lock:
+            self._last_flush[trial_id] = time.time()
+            return super()._flush_trial(trial_id)
+
+
+def batched_storage(storage: Union[str, optuna.storages.BaseStorage], flush_interval: float = 30.0):
+
+    """
+    Returns a BatchedStorage for an RDB storage (or url). Other storages are returned
+    as loaded by optuna, since they do not pay a round-trip per write.
+    """
+
+    storage = optuna.storages.get_storage(storage)
+    if flush_interval > 0 and isinstance(storage, _CachedStorage):
+        return BatchedStorage(storage._backend, flush_interval)
+    return storage
+
+
+class AskTellWorker:
+
+    """
+    Runs the trials of one worker with study.ask and study.tell, reusing the
+    same study (and so the same sampler state and storage cache) for every trial.
+
+    Hooks are called as hook(phase, seconds, trial) after each of the phases
+    "ask", "objective" and "tell". The durations are also kept in self.timings.
+
+    Inputs:
+        study: an Optuna study object (single or multi-objective)
+        objective: the objective to be optimized
+        hooks: a list of callables
+    """
+
+    def __init__(self,
+                 study: optuna.study.Study,
+                 objective: Callable,
+                 hooks: List[Callable] = None):
+
+        self.study = study
+        self.objective = objective
+        self.hooks = list(hooks) if hooks else []
+        self.timings = defaultdict(list)
+        self.trial = None # the trial that is running or ran last
+
+        # The multi-objective study wraps a regular study that does the ask/tell
+        self.multi_objective = isinstance(study, optuna.multi_objective.study.MultiObjectiveStudy)
+        self._study = study._study if self.multi_objective else study
+
+    def _record(self, phase, trial, start):
+        seconds = time.time() - start
+        self.timings[phase].append(seconds)
+        for hook in self.hooks:
+            hook(phase, seconds, trial)
+
+    def _already_finished(self, trial: optuna.trial.Trial, error: RuntimeError) -> bool:
+        # The storage refuses to update a trial that another worker has already
+        # finished, e.g. failed as stale (see reap_stale_trials). The cache may
+        # still hold the trial as running, so its state is read from the backend
+        storage = self._study._storage
+        backend = getattr(storage, "_backend", storage)
+        if not backend.get_trial(trial._trial_id).state.is_finished():
+            return False
+        logger.warning(
+            f"Trial {trial.number} was already finished by another worker, so its result was not recorded: {error}"
+        )
+        return True
+
+    def _tell_failed(self, trial: optuna.trial.Trial) -> None:
+        try:
+            self._study.tell(trial, state = optuna.trial.TrialState.FAIL)
+        except RuntimeError as E:
+            if not self._already_finished(trial, E):
+                raise
+
+    @property
+    def stopped(self) -> bool:
+        """True once study.stop() was called, e.g. by a GridSampler whose grid is used up."""
+        return bool(self._study._stop_flag)
+
+    def run_trial(self) -> optuna.trial.Trial:
+
+        """
+        Runs one trial. Errors raised by the objective are re-raised after the
+        trial has been marked as failed, as in study.optimize. A WallTimeExceeded
+        error puts the trial back in the queue instead (see check_wall_time).
+
+        The study's optimize lock is held while the trial runs, as in study.optimize,
+        so that the objective or the sampler (in after_trial) may call study.stop().
+        """
+
+        with self._study._optimize_lock:
+            return self._run_trial()
+
+    def _run_trial(self) -> optuna.trial.Trial:
+
+        start = time.time()
+        trial = self._study.ask()
+        self.trial = trial
+        # Lets the utilization report tell the workers apart
+        trial.set_system_attr(worker_key, worker_name())
+        self._record("ask", trial, start)
+
+        start = time.time()
+        state, values, error = optuna.trial.TrialState.COMPLETE, None, None
+        try:
+            if self.multi_objective:
+                mo_trial = optuna.multi_objective.trial.MultiObjectiveTrial(trial)
+                mo_trial._report_complete_values(self.objective(mo_trial))
+                values = 0.0 # the wrapped study only stores a dummy value
+            else:
+                values = self.objective(trial)
+        except optuna.TrialPruned as E:
+            state = optuna.trial.TrialState.PRUNED
+            logger.info(f"Trial {trial.number} pruned. {E}")
+        except WallTimeExceeded as E:
+            # The trial stopped before training, so it is not failed but put back in
+            # the queue with its parameters, for a worker with more time left
+            self._study._storage.set_trial_state(trial._trial_id, optuna.trial.TrialState.WAITING)
+            self._record("objective", trial, start)
+            logger.info(f"Trial {trial.number} was put back in the queue. {E}")
+            raise
+        except (Exception, KeyboardInterrupt) as E:
+            state, error = optuna.trial.TrialState.FAIL, E
+            logger.warning(f"Trial {trial.number} failed because of the following error: {repr(E)}")
+        self._record("objective", trial, start)
+
+        start = time.time()
+        try:
+            self._study.tell(
+                trial,
+                values = values if state == optuna.trial.TrialState.COMPLETE else None,
+                state = state
+            )
+        except ValueError as E: # e.g. the objective returned nan
+            logger.warning(f"Trial {trial.number} failed because of the following error: {repr(E)}")
+            self._tell_failed(trial)
+        except RuntimeError as E:
+            if not self._already_finished(trial, E):
+                raise
+        self._record("tell", trial, start)
+
+        if state == optuna.trial.TrialState.COMPLETE and not self.multi_objective:
+            logger.info(f"Trial {trial.number} finished with value(s): {values}")
+        if error is not None:
+            raise error
+        return trial
@@ -0,0 +1,165 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from aimlutils.echo.src.storage import trial_keys, iter_trials
+from typing import Dict, List, Union
+import pyarrow.parquet as pq
+import pandas as pd
+import pyarrow as pa
+import logging
+import optuna
+import json
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+supported_formats = ["parquet", "csv", "csv.gz"]
+
+
+def _is_categorical(distribution_json: str) -> bool:
+    return json.loads(distribution_json)["name"] == "CategoricalDistribution"
+
+
+def export_columns(keys: Dict[str, Dict[str, str]],
+                   n_objectives: int = 1) -> Dict[str, str]:
+
+    """
+    Returns the columns of the export and their pandas types. Categorical parameters
+    are exported as strings, and attributes as json strings.
+    """
+
+    columns = {"number": "int64", "state": "object"}
+    if n_objectives == 1:
+        columns["value"] = "float64"
+    else:
+        columns.update({f"values_{i}": "float64" for i in range(n_objectives)})
+    columns.update({
+        "datetime_start": "datetime64[ns]",
+        "datetime_complete": "datetime64[ns]",
+        "duration": "float64"
+    })
+    for name, dist in sorted(keys["params"].items()):
+        columns[f"params_{name}"] = "object" if _is_categorical(dist) else "float64"
+    for kind in ["user_attrs", "system_attrs"]:
+        columns.update({f"{kind}_{key}": "object" for key in sorted(keys[kind])})
+    columns["intermediate_values"] = "object"
+    return columns
+
+
+def _to_row(trial: optuna.trial.FrozenTrial,
+            categorical: List[str],
+            n_objectives: int = 1) -> Dict[str, object]:
+    row = {"number": trial.number, "state": trial.state.name}
+    if n_objectives == 1:
+        row["value"] = trial.value
+    else:
+        # Multi-objective studies store the values as the first intermediate values
+        row.update({f"values_{i}": trial.intermediate_values.get(i) for i in range(n_objectives)})
+    row["datetime_start"] = trial.datetime_start
+    row["datetime_complete"] = trial.datetime_complete
+    if trial.datetime_start is not None and trial.datetime_complete is not None:
+        row["duration"] = (trial.datetime_complete - trial.datetime_start).total_seconds()
+    for name, value in trial.params.items():
+        row[f"params_{name}"] = str(value) if name in categorical else value
+    row.update({f"user_attrs_{k}": json.dumps(v) for k, v in trial.user_attrs.items()})
+    row.update({f"system_attrs_{k}": json.dumps(v) for k, v in trial.system_attrs.items()})
+    row["intermediate_values"] = json.dumps(trial.intermediate_values)
+    return row
+
+
+def select_columns(columns: Dict[str, str], selection: List[str] = None) -> Dict[str, str]:
+
+    """
+    Keeps the columns named in selection, where a prefix such as "params" or
+    "system_attrs" selects all of the columns of that kind.
+    """
+
+    if not selection:
+        return columns
+    return {
+        name: dtype for name, dtype in columns.items()
+        if any([name == s or name.startswith(f"{s}_") for s in selection])
+    }
+
+
+def export_trials(storage: Union[str, optuna.storages.BaseStorage],
+                  study_name: str,
+                  path: str,
+                  file_format: str = "parquet",
+                  columns: List[str] = None,
+                  chunk_size: int = 1000,
+                  n_objectives: int = 1,
+                  extra_columns: Dict[str, Dict[int, float]] = None) -> int:
+
+    """
+    Writes the trials of a study to path, one chunk of trials at a time, so that
+    the memory used does not grow with the size of the study. The columns are
+    found up front with light queries, so every chunk has the same schema.
+
+    Inputs:
+        storage: the storage url or object
+        study_name: the name of the study
+        path: the file to write
+        file_format: "parquet" (a row group per chunk), "csv" or "csv.gz"
+        columns: the columns (or column prefixes, e.g. "params") to keep. Default is all.
+        chunk_size: the number of trials loaded and written at a time
+        n_objectives: the number of objectives of the study
+        extra_columns: more numeric columns, each a mapping from the trial number to
+            the value (e.g. the dominance rank of multi-objective trials)
+
+    Returns the number of trials written.
+    """
+
+    if file_format not in supported_formats:
+        raise OSError(f"Export format {file_format} is not valid. Select from {supported_formats}")
+
+    keys = trial_keys(storage, study_name)
+    categorical = [name for name, dist in keys["params"].items() if _is_categorical(dist)]
+    extra_columns = extra_columns or {}
+    dtypes = export_columns(keys, n_objectives)
+    dtypes.update({name: "float64" for name in extra_columns})
+    dtypes = select_columns(dtypes, columns)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    writer, n_trials = None, 0
+    try:
+        for chunk in iter_trials(storage, study_name, chunk_size):
+            df = pd.DataFrame([_to_row(t, categorical, n_objectives) for t in chunk])
+            for name, mapping in extra_columns.items():
+                df[name] = df["number"].map(mapping)
+            df = df.reindex(columns = list(dtypes))
+            df = df.astype({name: dtype for name, dtype in dtypes.items() if dtype != "object"})
+
+            if file_format == "parquet":
+                table = pa.Table.from_pandas(df, preserve_index = False)
+                if writer is None:
+                    schema = pa.Schema.from_pandas(df, preserve_index = False)
+                    # Columns that are empty in the first chunk hold strings
+                    schema = pa.schema([
+                        pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in schema
+                    ])
+                    writer = pq.ParquetWriter(tmp_path, schema)
+                writer.write_table(table.cast(writer.schema))
+            else:
+                df.to_csv(
+                    tmp_path,
+                    mode = "a" if n_trials else "w",
+                    header = n_trials == 0,
+                    index = False,
+                    compression = "gzip" if file_format == "csv.gz" else None
+                )
+            n_trials += len(chunk)
+            logger.debug(f"Exported {n_trials} trials to {path}")
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if n_trials == 0: # an empty study
+        if file_format == "parquet":
+            pd.DataFrame(columns = list(dtypes)).to_parquet(tmp_path, index = False)
+        else:
+            pd.DataFrame(columns = list(dtypes)).to_csv(tmp_path, index = False)
+    os.replace(tmp_path, path)
+    return n_trials
@@ -0,0 +1,164 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from aimlutils.echo.src.resume import resume_attrs, resume_step_key
+from typing import Dict, List
+import threading
+import logging
+import socket
+import optuna
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+heartbeat_key = "echo:heartbeat"
+worker_key = "echo:worker"
+retries_key = "echo:retries"
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _backend(storage):
+    # Write around any caching/batching layer so that heartbeats are seen immediately
+    return getattr(storage, "_backend", storage)
+
+
+class Heartbeat:
+
+    """
+    Records the time in the system attributes of a running trial every interval
+    seconds from a background thread, so that trials whose worker was killed
+    can be told apart from trials that are still running (see reap_stale_trials).
+    Does nothing if interval is None.
+
+    Usage:
+        with Heartbeat(trial, interval = 60):
+            train(...)
+    """
+
+    def __init__(self, trial: optuna.trial.Trial, interval: float = None):
+
+        trial = getattr(trial, "_trial", trial) # multi-objective trials wrap a trial
+        self.storage = _backend(trial.study._storage)
+        self.trial_id = trial._trial_id
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def beat(self) -> bool:
+        try:
+            self.storage.set_trial_system_attr(self.trial_id, heartbeat_key, time.time())
+            return True
+        except Exception as E: # e.g. the trial was reaped by another worker
+            logger.warning(f"Could not record a heartbeat for trial id {self.trial_id}: {E}")
+            return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.beat():
+                break
+
+    def __enter__(self):
+        if self.interval is None:
+            return self
+        self.storage.set_trial_system_attr(self.trial_id, worker_key, worker_name())
+        self.beat()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+
+
+def enqueue_retry(study: optuna.study.Study,
+                  trial: optuna.trial.FrozenTrial,
+                  system_attrs: Dict[str, str] = None) -> None:
+
+    """
+    Puts the parameters of trial back in the study queue, to be picked up by the
+    next worker that asks for a trial. The number of retries is tracked in the
+    system attributes of the new trial.
+    
+    If trial recorded a checkpoint (see resume.record_checkpoint), the new trial 
+    resumes from it: it inherits the intermediate values up to the checkpoint step,
+    and the objective can load the checkpoint with BaseObjective.resume_state.
+    """
+
+    study = getattr(study, "_study", study)
+    attrs = {
+        "fixed_params": dict(trial.params),
+        retries_key: int(trial.system_attrs.get(retries_key, 0)) + 1
+    }
+    attrs.update(resume_attrs(trial))
+    attrs.update(system_attrs or {})
+    
+    intermediate_values = {}
+    if resume_step_key in attrs:
+        intermediate_values = {
+            step: value for step, value in trial.intermediate_values.items() 
+            if step <= attrs[resume_step_key] and value is not None
+        }
+        
+    study.add_trial(
+        optuna.trial.create_trial(
+            state = optuna.trial.TrialState.WAITING, 
+            system_attrs = attrs,
+            intermediate_values = intermediate_values
+        )
+    )
+
+
+def reap_stale_trials(study: optuna.study.Study,
+                      grace_period: float = 600,
+                      retry: bool = False,
+                      max_retries: int = 1) -> List[int]:
+
+    """
+    Marks running trials whose last heartbeat is older than grace_period seconds
+    as failed. If retry is True, their parameters are put back in the queue, unless
+    they have already been retried max_retries times.
+
+    Trials without a heartbeat (e.g. started by workers without heartbeats enabled)
+    are left alone.
+
+    Returns the numbers of the reaped trials.
+    """
+
+    _study = getattr(study, "_study", study)
+    storage = _backend(_study._storage)
+    now = time.time()
+
+    reaped = []
+    running = storage.get_all_trials(
+        _study._study_id, deepcopy = False, states = (optuna.trial.TrialState.RUNNING,)
+    )
+    for trial in running:
+        last_beat = trial.system_attrs.get(heartbeat_key, None)
+        if last_beat is None or (now - last_beat) < grace_period:
+            continue
+        try:
+            storage.set_trial_state(trial._trial_id, optuna.trial.TrialState.FAIL)
+        except RuntimeError: # another worker reaped it first
+            continue
+        reaped.append(trial.number)
+
+        worker = trial.system_attrs.get(worker_key, "unknown")
+        logger.warning(
+            f"Trial {trial.number} on worker {worker} missed its heartbeat for {now - last_beat:.0f} seconds and was marked as failed"
+        )
+        if retry:
+            if int(trial.system_attrs.get(retries_key, 0)) < max_retries:
+                enqueue_retry(_study, trial)
+                logger.info(f"The parameters of trial {trial.number} were put back in the queue")
+            else:
+                logger.info(f"Trial {trial.number} was already retried {max_retries} times")
+
+    return reaped
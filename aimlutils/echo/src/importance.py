@@ -0,0 +1,115 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+import numpy as np
+import logging
+import optuna
+import json
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+evaluators = {
+    "fanova": optuna.importance.FanovaImportanceEvaluator,
+    "mdi": optuna.importance.MeanDecreaseImpurityImportanceEvaluator
+}
+
+
+def _set_n_jobs(evaluator, n_jobs: int) -> None:
+    # Both evaluators fit a scikit-learn random forest, which optuna does not expose
+    for obj in [evaluator, getattr(evaluator, "_evaluator", None)]:
+        forest = getattr(obj, "_forest", None)
+        if forest is not None and hasattr(forest, "n_jobs"):
+            forest.set_params(n_jobs = n_jobs)
+
+
+def _evaluate(name: str,
+              trials: List[optuna.trial.FrozenTrial],
+              direction: str,
+              n_trees: int,
+              max_depth: int,
+              seed: int,
+              n_jobs: int) -> Dict[str, float]:
+    study = optuna.create_study(direction = direction)
+    study.add_trials(trials)
+    evaluator = evaluators[name](n_trees = n_trees, max_depth = max_depth, seed = seed)
+    _set_n_jobs(evaluator, n_jobs)
+    return dict(evaluator.evaluate(study = study))
+
+
+def parameter_importance(study: optuna.study.Study,
+                         names: List[str] = ["fanova", "mdi"],
+                         n_trees: int = 64,
+                         max_depth: int = 64,
+                         subsample: int = None,
+                         seed: int = None,
+                         n_jobs: int = 1,
+                         cache_path: str = None) -> Dict[str, Dict[str, float]]:
+
+    """
+    Computes the parameter importance of a single-objective study with each of the
+    evaluators in names ("fanova" and/or "mdi").
+
+    Inputs:
+        study: an Optuna study object
+        names: the evaluators to use
+        n_trees: the number of trees in the random forests
+        max_depth: the maximum depth of the trees
+        subsample: if set, the number of completed trials (picked at random) to fit on
+        seed: the seed for the subsampling and the random forests
+        n_jobs: the number of processes; the evaluators run side by side and share
+            the rest between their random forests
+        cache_path: a json file where the results are kept until more trials complete
+    """
+
+    complete = study.get_trials(deepcopy = False, states = (optuna.trial.TrialState.COMPLETE,))
+    direction = study.direction.name.lower()
+    settings = f"{len(complete)}:{n_trees}:{max_depth}:{subsample}:{seed}"
+
+    cache = {}
+    if cache_path is not None and os.path.isfile(cache_path):
+        with open(cache_path) as fid:
+            cache = json.load(fid)
+        if cache.get("study") != study.study_name or cache.get("n_complete") != len(complete):
+            cache = {} # new trials completed since the cache was written
+
+    results = {}
+    for name in names:
+        if f"{name}:{settings}" in cache.get("results", {}):
+            results[name] = cache["results"][f"{name}:{settings}"]
+            logger.info(f"Loaded the {name} parameter importance from {cache_path}")
+    missing = [name for name in names if name not in results]
+
+    if len(missing):
+        trials = complete
+        if subsample is not None and subsample < len(complete):
+            rng = np.random.RandomState(seed)
+            picked = sorted(rng.choice(len(complete), size = subsample, replace = False))
+            trials = [complete[i] for i in picked]
+            logger.info(f"Computing the parameter importance from {subsample} of {len(complete)} completed trials")
+
+        args = [(name, trials, direction, n_trees, max_depth, seed) for name in missing]
+        if n_jobs > 1 and len(missing) > 1:
+            forest_jobs = max(1, n_jobs // len(missing))
+            with ProcessPoolExecutor(max_workers = len(missing)) as executor:
+                futures = [executor.submit(_evaluate, *arg, forest_jobs) for arg in args]
+                computed = [future.result() for future in futures]
+        else:
+            computed = [_evaluate(*arg, n_jobs) for arg in args]
+        results.update(dict(zip(missing, computed)))
+
+        if cache_path is not None:
+            cache_results = cache.get("results", {})
+            cache_results.update({f"{name}:{settings}": results[name] for name in missing})
+            with open(cache_path, "w") as fid:
+                json.dump({
+                    "study": study.study_name,
+                    "n_complete": len(complete),
+                    "results": cache_results
+                }, fid)
+
+    return {name: results[name] for name in names}
@@ -0,0 +1,257 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from typing import Callable, Dict
+import functools
+import threading
+import inspect
+import logging
+import socket
+import optuna
+import json
+import glob
+import math
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+# Latencies are counted in logarithmic buckets from 1 microsecond, 20 per decade
+# (12% wide), so that the histograms of the workers can be added together
+bucket_start = 1e-6
+buckets_per_decade = 20
+reported_percentiles = [50, 95, 99]
+
+
+def bucket(seconds: float) -> int:
+
+    """
+    Returns the index of the latency bucket of seconds.
+    """
+
+    if seconds <= bucket_start:
+        return 0
+    return int(math.floor(math.log10(seconds / bucket_start) * buckets_per_decade))
+
+
+def bucket_seconds(index: int) -> float:
+
+    """
+    Returns the upper edge of a latency bucket, in seconds.
+    """
+
+    return bucket_start * 10 ** ((index + 1) / buckets_per_decade)
+
+
+def percentile(histogram: Dict[int, int], q: float) -> float:
+
+    """
+    Returns the q-th percentile (0-100) of the latencies counted in histogram,
+    as the upper edge of the bucket that holds it.
+    """
+
+    total = sum(histogram.values())
+    if total == 0:
+        return float("nan")
+    rank, seen = q / 100.0 * total, 0
+    for index in sorted(histogram):
+        seen += histogram[index]
+        if seen >= rank:
+            return bucket_seconds(index)
+    return bucket_seconds(max(histogram))
+
+
+def summarize(method_stats: Dict[str, object]) -> Dict[str, float]:
+
+    """
+    Returns the count, total, mean, max and percentile latencies (p50, p95, p99)
+    of a method from its count, total, max and histogram. The percentiles are
+    no larger than the max, which is known exactly.
+    """
+
+    summary = {
+        "count": method_stats["count"],
+        "total": method_stats["total"],
+        "mean": method_stats["total"] / max(method_stats["count"], 1)
+    }
+    for q in reported_percentiles:
+        summary[f"p{q}"] = min(percentile(method_stats["histogram"], q), method_stats["max"])
+    summary["max"] = method_stats["max"]
+    return summary
+
+
+# The calls outside the storage interface that optuna's cache (and so the
+# BatchedStorage) makes to a database
+cache_methods = [
+    "_create_new_trial", "_get_trials", "_update_trial",
+    "_check_and_set_param_distribution", "_get_stale_trial_ids"
+]
+
+
+def _timed(method: Callable) -> Callable:
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        # Only the outermost call is timed, since one storage call may make others
+        if getattr(self._timing_state, "active", False):
+            return method(self, *args, **kwargs)
+        self._timing_state.active = True
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._timing_state.active = False
+            self._record(method.__name__, time.perf_counter() - start)
+    return call
+
+
+class InstrumentedStorage:
+
+    """
+    Records the number of calls, the total time and a histogram of the latencies
+    of each method of a storage class. Mixed into the storage class that talks to
+    the database (or journal file) by instrumented, so that only the calls that
+    reach it are timed: the calls that the cache and batching layers of the worker
+    answer from memory are not, while those made around them (e.g. heartbeats,
+    flushes of the batched writes) are.
+    """
+
+    def __init__(self, *args, **kwargs):
+
+        self._stats = {}
+        self._start = time.time()
+        # Heartbeats are recorded from another thread
+        self._stats_lock = threading.Lock()
+        self._timing_state = threading.local()
+        super().__init__(*args, **kwargs)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state["_stats_lock"], state["_timing_state"]
+        return state
+
+    def __setstate__(self, state):
+        state["_stats_lock"] = threading.Lock()
+        state["_timing_state"] = threading.local()
+        super().__setstate__(state)
+
+    def __reduce__(self):
+        # The subclass is made at run time, so it is pickled by its storage class
+        return (_unpickle, (self._storage_class, self.__getstate__()))
+
+    def _record(self, name: str, seconds: float) -> None:
+        with self._stats_lock:
+            stats = self._stats.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0, "histogram": {}})
+            stats["count"] += 1
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            index = bucket(seconds)
+            stats["histogram"][index] = stats["histogram"].get(index, 0) + 1
+
+    def stats(self) -> Dict[str, object]:
+
+        """
+        Returns the seconds since the storage was created ("wall") and the count,
+        total, max and latency histogram of each method ("methods").
+        """
+
+        with self._stats_lock:
+            methods = {
+                name: dict(stats, histogram = dict(stats["histogram"]))
+                for name, stats in self._stats.items()
+            }
+        return {"wall": time.time() - self._start, "methods": methods}
+
+    def dump(self, path: str, phases: Dict[str, float] = None) -> None:
+
+        """
+        Saves the stats (and, optionally, the seconds the worker spent in each
+        phase of its trials) as json to path. The file is replaced at once, so a
+        report never reads half of it.
+        """
+
+        stats = self.stats()
+        stats["host"] = socket.gethostname()
+        stats["pid"] = os.getpid()
+        stats["phases"] = dict(phases) if phases else {}
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as fid:
+            json.dump(stats, fid)
+        os.replace(tmp_path, path)
+
+
+_instrumented_classes = {}
+
+
+def instrumented(storage_class: type) -> type:
+
+    """
+    Returns a subclass of storage_class (e.g. RDBStorage) that times every call of
+    the storage interface, and of the bulk methods used by optuna's cache.
+    """
+
+    if storage_class not in _instrumented_classes:
+        cls = type(
+            f"Instrumented{storage_class.__name__}",
+            (InstrumentedStorage, storage_class),
+            {"_storage_class": storage_class}
+        )
+        names = [name for name in dir(optuna.storages.BaseStorage) if not name.startswith("_")]
+        for name in names + cache_methods:
+            if name == "remove_session" or not hasattr(storage_class, name):
+                continue
+            if isinstance(inspect.getattr_static(storage_class, name), (staticmethod, classmethod)):
+                continue
+            setattr(cls, name, _timed(getattr(storage_class, name)))
+        _instrumented_classes[storage_class] = cls
+    return _instrumented_classes[storage_class]
+
+
+def _unpickle(storage_class: type, state: Dict[str, object]) -> InstrumentedStorage:
+    storage = instrumented(storage_class).__new__(instrumented(storage_class))
+    storage.__setstate__(state)
+    return storage
+
+
+def stats_path(directory: str, worker_index: int) -> str:
+
+    """
+    Returns the json file of a worker in directory, named after the host, the
+    index of the worker and its process id, so that restarted workers do not
+    overwrite the stats of earlier ones.
+    """
+
+    return os.path.join(directory, f"{socket.gethostname()}_{worker_index}_{os.getpid()}.json")
+
+
+def aggregate_stats(directory: str) -> Dict[str, object]:
+
+    """
+    Returns the stats of every worker in directory added together: the number of
+    workers ("workers"), their summed wall times ("wall") and phase times
+    ("phases"), and the summary (see summarize) of each storage method ("methods").
+    """
+
+    wall, phases, methods = 0.0, {}, {}
+    paths = sorted(glob.glob(os.path.join(directory, "*.json")))
+    for path in paths:
+        with open(path, "r") as fid:
+            stats = json.load(fid)
+        wall += stats["wall"]
+        for phase, seconds in stats.get("phases", {}).items():
+            phases[phase] = phases.get(phase, 0.0) + seconds
+        for name, method_stats in stats["methods"].items():
+            merged = methods.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0, "histogram": {}})
+            merged["count"] += method_stats["count"]
+            merged["total"] += method_stats["total"]
+            merged["max"] = max(merged["max"], method_stats["max"])
+            for index, count in method_stats["histogram"].items():
+                # json keys are strings
+                merged["histogram"][int(index)] = merged["histogram"].get(int(index), 0) + count
+    return {
+        "workers": len(paths),
+        "wall": wall,
+        "phases": phases,
+        "methods": {name: summarize(stats) for name, stats in methods.items()}
+    }
@@ -0,0 +1,283 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from optuna.storages import InMemoryStorage
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+import threading
+import datetime
+import logging
+import optuna
+import fcntl
+import json
+import time
+import uuid
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+supported_locks = ["flock", "open"]
+
+
+def _encode_time(value: datetime.datetime) -> str:
+    return value.isoformat() if value is not None else None
+
+
+def _decode_time(value: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(value) if value is not None else None
+
+
+def encode_trial(trial: optuna.trial.FrozenTrial) -> Dict[str, object]:
+
+    """
+    Returns a json-serializable dict of a trial used as the template of a new trial.
+    """
+
+    return {
+        "state": trial.state.value,
+        "values": trial.values,
+        "datetime_start": _encode_time(trial.datetime_start),
+        "datetime_complete": _encode_time(trial.datetime_complete),
+        "params": {
+            name: trial.distributions[name].to_internal_repr(value)
+            for name, value in trial.params.items()
+        },
+        "distributions": {
+            name: optuna.distributions.distribution_to_json(dist)
+            for name, dist in trial.distributions.items()
+        },
+        "user_attrs": trial.user_attrs,
+        "system_attrs": trial.system_attrs,
+        # json keys are strings
+        "intermediate_values": [[step, value] for step, value in trial.intermediate_values.items()]
+    }
+
+
+def decode_trial(record: Dict[str, object]) -> optuna.trial.FrozenTrial:
+
+    """
+    Returns the trial that encode_trial encoded (with a dummy number and id).
+    """
+
+    distributions = {
+        name: optuna.distributions.json_to_distribution(dist)
+        for name, dist in record["distributions"].items()
+    }
+    return optuna.trial.FrozenTrial(
+        number = -1,
+        trial_id = -1,
+        state = optuna.trial.TrialState(record["state"]),
+        value = None,
+        values = record["values"],
+        datetime_start = _decode_time(record["datetime_start"]),
+        datetime_complete = _decode_time(record["datetime_complete"]),
+        params = {
+            name: distributions[name].to_external_repr(value)
+            for name, value in record["params"].items()
+        },
+        distributions = distributions,
+        user_attrs = record["user_attrs"],
+        system_attrs = record["system_attrs"],
+        intermediate_values = {int(step): value for step, value in record["intermediate_values"]}
+    )
+
+
+class JournalFileStorage(optuna.storages.BaseStorage):
+
+    """
+    A storage that appends every change to the studies to a log file (one json
+    record per line) and rebuilds the studies by replaying the log in memory.
+
+    A change is made while holding a lock on the log: the records appended by the
+    other workers are replayed first, the change is checked against the studies
+    (e.g. that the trial is still running, or still waiting to be claimed), and only
+    then is it appended, in a single write. Reads replay the new records without
+    the lock, up to the last complete line. Unlike a database, readers never wait
+    for writers and writers only wait for each other for the length of one append.
+
+    The changes are recorded as the calls of the storage interface (one record per
+    call), so the log is replayed into an InMemoryStorage with the same ids.
+
+    Inputs:
+        path: the log file
+        lock: "flock" to lock the file path.lock with fcntl.flock, or "open" to
+            create path.lock exclusively, for filesystems without flock support
+        lock_timeout: for "open" locks, seconds after which a lock file left by a
+            killed worker is removed
+    """
+
+    def __init__(self, path: str, lock: str = "flock", lock_timeout: float = 30.0):
+
+        if lock not in supported_locks:
+            raise OSError(
+                f"The journal lock {lock} is not supported. Select from {supported_locks}"
+            )
+        self.path = path
+        self.lock = lock
+        self.lock_timeout = lock_timeout
+        self._lock_path = f"{path}.lock"
+        self._replica = InMemoryStorage()
+        self._offset = 0
+        # Heartbeats are recorded from another thread
+        self._thread_lock = threading.RLock()
+        if not os.path.isfile(path):
+            open(path, "a").close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_thread_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._thread_lock = threading.RLock()
+
+    @contextmanager
+    def _file_lock(self):
+        if self.lock == "flock":
+            with open(self._lock_path, "a") as fid:
+                fcntl.flock(fid, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fid, fcntl.LOCK_UN)
+            return
+        while True:
+            try:
+                fd = os.open(self._lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self._lock_path) > self.lock_timeout:
+                        logger.warning(f"Removing the stale journal lock {self._lock_path}")
+                        os.remove(self._lock_path)
+                        continue
+                except FileNotFoundError: # released in the meantime
+                    continue
+                time.sleep(0.001)
+        os.close(fd)
+        try:
+            yield
+        finally:
+            os.remove(self._lock_path)
+
+    def _replay(self) -> None:
+        with open(self.path, "rb") as fid:
+            fid.seek(self._offset)
+            data = fid.read()
+        # A record that is being appended is read on the next call
+        for line in data[:data.rfind(b"\n") + 1].splitlines(keepends = True):
+            if line.strip():
+                self._apply(json.loads(line))
+            self._offset += len(line)
+
+    def _apply(self, record: Dict[str, object]):
+        op, args = record["op"], list(record["args"])
+        if op == "set_study_directions":
+            args[1] = [optuna.study.StudyDirection(d) for d in args[1]]
+        elif op == "create_new_trial":
+            args[1] = decode_trial(args[1])
+        elif op == "set_trial_state":
+            args[1] = optuna.trial.TrialState(args[1])
+            if args[1] == optuna.trial.TrialState.RUNNING and self._replica._get_trial(args[0]).state.is_finished():
+                return False # a waiting trial that another worker claimed and already finished
+        elif op == "set_trial_param":
+            args[3] = optuna.distributions.json_to_distribution(args[3])
+        result = getattr(self._replica, op)(*args)
+        if op == "set_trial_state" and result:
+            # Every replica keeps the time of the worker that made the change
+            trial = self._replica._get_trial(args[0])
+            if args[1] == optuna.trial.TrialState.RUNNING:
+                trial.datetime_start = _decode_time(record["time"])
+            if args[1].is_finished():
+                trial.datetime_complete = _decode_time(record["time"])
+        return result
+
+    def _write(self, record: Dict[str, object]):
+        with self._thread_lock, self._file_lock():
+            self._replay()
+            result = self._apply(record)
+            # A trial that another worker claimed first is not changed, so not logged
+            if result is not False:
+                with open(self.path, "ab") as fid:
+                    fid.write((json.dumps(record) + "\n").encode())
+                    self._offset = fid.tell()
+            return result
+
+    def create_new_study(self, study_name: str = None) -> int:
+        if study_name is None: # the name must be the same in every replica
+            study_name = f"no-name-{uuid.uuid4()}"
+        return self._write({"op": "create_new_study", "args": [study_name]})
+
+    def delete_study(self, study_id: int) -> None:
+        self._write({"op": "delete_study", "args": [study_id]})
+
+    def set_study_directions(self, study_id: int, directions: List[optuna.study.StudyDirection]) -> None:
+        self._write({"op": "set_study_directions", "args": [study_id, [d.value for d in directions]]})
+
+    def set_study_user_attr(self, study_id: int, key: str, value) -> None:
+        self._write({"op": "set_study_user_attr", "args": [study_id, key, value]})
+
+    def set_study_system_attr(self, study_id: int, key: str, value) -> None:
+        self._write({"op": "set_study_system_attr", "args": [study_id, key, value]})
+
+    def create_new_trial(self, study_id: int, template_trial: optuna.trial.FrozenTrial = None) -> int:
+        if template_trial is None:
+            template_trial = InMemoryStorage._create_running_trial()
+        return self._write({"op": "create_new_trial", "args": [study_id, encode_trial(template_trial)]})
+
+    def set_trial_state(self, trial_id: int, state: optuna.trial.TrialState) -> bool:
+        return self._write({
+            "op": "set_trial_state",
+            "args": [trial_id, state.value],
+            "time": _encode_time(datetime.datetime.now())
+        })
+
+    def set_trial_param(self,
+                        trial_id: int,
+                        param_name: str,
+                        param_value_internal: float,
+                        distribution: optuna.distributions.BaseDistribution) -> None:
+        self._write({
+            "op": "set_trial_param",
+            "args": [
+                trial_id, param_name, param_value_internal,
+                optuna.distributions.distribution_to_json(distribution)
+            ]
+        })
+
+    def set_trial_values(self, trial_id: int, values: List[float]) -> None:
+        self._write({"op": "set_trial_values", "args": [trial_id, list(values)]})
+
+    def set_trial_intermediate_value(self, trial_id: int, step: int, intermediate_value: float) -> None:
+        self._write({"op": "set_trial_intermediate_value", "args": [trial_id, step, intermediate_value]})
+
+    def set_trial_user_attr(self, trial_id: int, key: str, value) -> None:
+        self._write({"op": "set_trial_user_attr", "args": [trial_id, key, value]})
+
+    def set_trial_system_attr(self, trial_id: int, key: str, value) -> None:
+        self._write({"op": "set_trial_system_attr", "args": [trial_id, key, value]})
+
+    def read_trials_from_remote_storage(self, study_id: int) -> None:
+        with self._thread_lock:
+            self._replay()
+
+
+def _replayed(name: str) -> Callable:
+    def call(self, *args, **kwargs):
+        with self._thread_lock:
+            self._replay()
+            return getattr(self._replica, name)(*args, **kwargs)
+    call.__name__ = name
+    return call
+
+
+# The other calls read the studies, after replaying the records of the other workers
+for _name in [name for name in dir(optuna.storages.BaseStorage) if not name.startswith("_")]:
+    if _name in vars(JournalFileStorage):
+        continue
+    setattr(JournalFileStorage, _name, _replayed(_name))
+# The methods were added after the class was created, so it is no longer abstract
+JournalFileStorage.__abstractmethods__ = frozenset()
@@ -0,0 +1,160 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from aimlutils.utils.gpu import gpu_report
+from aimlutils.echo.src.storage import load_storage
+from typing import Dict, List
+import subprocess
+import datetime
+import logging
+import optuna
+import signal
+import time
+import sys
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+def local_devices(hyper_config: Dict[str, str], n_workers: int) -> List[str]:
+
+    """
+        Assigns a device to each local worker. Workers are spread round-robin
+        over the gpus reported by nvidia-smi, or all use the cpu.
+    """
+
+    if bool(hyper_config["optuna"]["gpu"]):
+        try:
+            gpus = sorted(gpu_report().items(), key = lambda x: x[1], reverse = True)
+            gpus = [str(device) for device, free_memory in gpus]
+        except:
+            logger.warning(
+                "The gpu is not responding to a call from nvidia-smi. Setting gpu device = 0, but this may fail."
+            )
+            gpus = ["0"]
+        return [gpus[worker % len(gpus)] for worker in range(n_workers)]
+    return ["cpu"] * n_workers
+
+
+def fail_running_trials(hyper_config: Dict[str, str], since: datetime.datetime) -> List[int]:
+
+    """
+        Marks the trials that are still running and were started after since
+        (i.e. by the local workers, which have all exited) as failed.
+
+        Returns the numbers of the failed trials.
+    """
+
+    storage = optuna.storages.get_storage(load_storage(hyper_config["optuna"]))
+    study_id = storage.get_study_id_from_name(hyper_config["optuna"]["study_name"])
+    failed = []
+    for t in storage.get_all_trials(study_id, deepcopy = False):
+        if t.state != optuna.trial.TrialState.RUNNING or t.datetime_start is None or t.datetime_start < since:
+            continue
+        try:
+            storage.set_trial_state(t._trial_id, optuna.trial.TrialState.FAIL)
+            failed.append(t.number)
+        except RuntimeError: # the trial finished in the meantime
+            pass
+    return failed
+
+
+def stop_workers(processes: Dict[int, subprocess.Popen], timeout: float) -> Dict[int, int]:
+
+    """
+        Interrupts the workers, so that each one fails its current trial and exits,
+        and terminates the workers that are still running after timeout seconds.
+
+        Returns the exit code of each worker.
+    """
+
+    for process in processes.values():
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+    deadline = time.time() + timeout
+    exit_codes = {}
+    for worker, process in processes.items():
+        try:
+            exit_codes[worker] = process.wait(timeout = max(0, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Local worker {worker + 1} did not stop within {timeout} s. Terminating it.")
+            process.terminate()
+            exit_codes[worker] = process.wait()
+    return exit_codes
+
+
+def launch_local_workers(hyper_config: Dict[str, str],
+                         hyperparameter_path: str,
+                         model_path: str) -> List[int]:
+
+    """
+        Runs the workers as supervised run.py subprocesses on the current machine.
+
+        Each worker runs up to n_trials trials (as on slurm or pbs) and exits cleanly
+        once its last trial has finished. A worker that exits with an error is
+        restarted (up to local:max_restarts times), while a worker that exits cleanly
+        is not. On a keyboard interrupt the workers are interrupted, and given up to
+        local:stop_timeout seconds to fail their current trial and exit. Trials that
+        the workers left running are then marked as failed.
+
+        Blocks until all of the workers have exited and returns their exit codes.
+    """
+
+    local_config = hyper_config["local"]
+    n_workers = int(local_config.get("workers", 1))
+    max_restarts = int(local_config.get("max_restarts", 3))
+    poll_interval = float(local_config.get("poll_interval", 10))
+    stop_timeout = float(local_config.get("stop_timeout", 60))
+
+    run_path = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "run.py"
+    )
+    command = [sys.executable, run_path, hyperparameter_path, model_path]
+    devices = local_devices(hyper_config, n_workers)
+
+    def start(worker):
+        env = dict(os.environ)
+        env["ECHO_DEVICE"] = devices[worker]
+        env["ECHO_WORKER_INDEX"] = str(worker)
+        process = subprocess.Popen(command, env = env)
+        logger.info(
+            f"Started local worker {worker + 1}/{n_workers} on device {devices[worker]} with pid {process.pid}"
+        )
+        return process
+
+    # The database clock may differ from ours, so leave a margin for trials started by the workers
+    launched = datetime.datetime.now() - datetime.timedelta(seconds = 1)
+    processes = {worker: start(worker) for worker in range(n_workers)}
+    restarts = {worker: 0 for worker in range(n_workers)}
+    exit_codes = {}
+
+    try:
+        while processes:
+            time.sleep(poll_interval)
+
+            for worker, process in list(processes.items()):
+                code = process.poll()
+                if code is None:
+                    continue
+                if code != 0 and restarts[worker] < max_restarts:
+                    restarts[worker] += 1
+                    logger.warning(
+                        f"Local worker {worker + 1} exited with code {code}. Restart {restarts[worker]}/{max_restarts}"
+                    )
+                    processes[worker] = start(worker)
+                else:
+                    logger.info(f"Local worker {worker + 1} exited with code {code}")
+                    exit_codes[worker] = code
+                    processes.pop(worker)
+
+    except KeyboardInterrupt:
+        logger.warning("Recieved signal to die from keyboard. Stopping the local workers.")
+        exit_codes.update(stop_workers(processes, stop_timeout))
+
+    failed = fail_running_trials(hyper_config, launched)
+    if len(failed):
+        logger.warning(f"Marked the trials {failed} that the stopped workers left running as failed")
+
+    return [exit_codes[worker] for worker in sorted(exit_codes)]
@@ -0,0 +1,273 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from typing import List, Tuple
+import numpy as np
+import logging
+import optuna
+import bisect
+
+
+logger = logging.getLogger(__name__)
+
+
+def to_minimize(values: np.ndarray, directions: List[str]) -> np.ndarray:
+
+    """
+    Returns the values (n_points x n_objectives) with the objectives
+    that are maximized negated, so that every objective is minimized.
+    """
+
+    signs = np.array([-1.0 if d == "maximize" else 1.0 for d in directions])
+    return np.asarray(values, dtype = float) * signs
+
+
+def _ranks_2d(points: np.ndarray) -> np.ndarray:
+    # Unique points sorted by (f0, f1): an earlier point dominates a later one
+    # iff its f1 is not larger. The smallest f1 of each front increases with the
+    # rank, so the rank of a point is found by bisection.
+    order = np.lexsort((points[:, 1], points[:, 0]))
+    ranks = np.empty(len(points), dtype = int)
+    front_mins = []
+    for i in order:
+        rank = bisect.bisect_right(front_mins, points[i, 1])
+        if rank == len(front_mins):
+            front_mins.append(points[i, 1])
+        else:
+            front_mins[rank] = points[i, 1]
+        ranks[i] = rank
+    return ranks
+
+
+def _non_dominated(points: np.ndarray, block_size: int = 256) -> np.ndarray:
+    # Unique points sorted lexicographically can only be dominated by earlier points.
+    # Each block is compared at once with the front found so far and with itself.
+    order = np.lexsort(points.T[::-1])
+    front = np.empty((0, points.shape[1]))
+    mask = np.zeros(len(points), dtype = bool)
+    for start in range(0, len(order), block_size):
+        index = order[start:start + block_size]
+        block = points[index]
+        if len(front):
+            # Points dominated by a dominated point are also dominated by the front,
+            # so only the points that the front leaves are compared with each other
+            survive = ~np.all(front[None, :, :] <= block[:, None, :], axis = 2).any(axis = 1)
+            index, block = index[survive], block[survive]
+        # within a block, row j dominates row i when j comes first and is not larger anywhere
+        within = np.all(block[None, :, :] <= block[:, None, :], axis = 2)
+        dominated = np.tril(within, k = -1).any(axis = 1)
+        mask[index[~dominated]] = True
+        front = np.vstack([front, block[~dominated]])
+    return mask
+
+
+def _ranks_nd(points: np.ndarray, max_rank: int = None) -> np.ndarray:
+    # Unique points in lexicographic order can only be dominated by earlier points.
+    # A point dominated by a member of front k is also dominated by a member of every
+    # front before k, so its rank is the first front without a dominator, found by
+    # bisection over the fronts (efficient non-dominated sort with binary search).
+    # Points behind the first max_rank fronts are not kept, so they cost no comparisons.
+    order = np.lexsort(points.T[::-1])
+    ranks = np.empty(len(points), dtype = int)
+    fronts, sizes = [], []
+    for i in order:
+        p = points[i]
+        lo, hi = 0, len(fronts)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if np.all(fronts[mid][:sizes[mid]] <= p, axis = 1).any():
+                lo = mid + 1
+            else:
+                hi = mid
+        if max_rank is not None and lo >= max_rank:
+            ranks[i] = max_rank
+            continue
+        if lo == len(fronts):
+            fronts.append(np.empty((16, points.shape[1])))
+            sizes.append(0)
+        if sizes[lo] == len(fronts[lo]): # grow the front buffer
+            fronts[lo] = np.vstack([fronts[lo], np.empty_like(fronts[lo])])
+        fronts[lo][sizes[lo]] = p
+        sizes[lo] += 1
+        ranks[i] = lo
+    return ranks
+
+
+def non_dominated_sort(values: np.ndarray,
+                       directions: List[str],
+                       max_rank: int = None) -> np.ndarray:
+
+    """
+    Returns the dominance rank of each point: 0 for the Pareto front, 1 for the
+    front of the remaining points, and so on. Identical points get the same rank.
+    Two objectives are ranked in O(n log n). With more objectives, the first few
+    fronts are peeled off with vectorized block comparisons, and full rankings
+    bisect over the fronts for each point. If max_rank is set, the points behind
+    the first max_rank fronts all get rank max_rank.
+
+    Inputs:
+        values: an array of n_points x n_objectives
+        directions: "minimize" or "maximize" for each objective
+        max_rank: the number of fronts to rank
+    """
+
+    points = to_minimize(values, directions)
+    if len(points) == 0:
+        return np.zeros(0, dtype = int)
+    points, inverse = np.unique(points, axis = 0, return_inverse = True)
+    inverse = np.asarray(inverse).reshape(-1)
+
+    if points.shape[1] == 2 or max_rank is None or max_rank > 3:
+        ranks = _ranks_2d(points) if points.shape[1] == 2 else _ranks_nd(points, max_rank)
+        if max_rank is not None:
+            ranks = np.minimum(ranks, max_rank)
+        return ranks[inverse]
+
+    ranks = np.full(len(points), -1, dtype = int)
+    remaining = np.arange(len(points))
+    rank = 0
+    while len(remaining) and (max_rank is None or rank < max_rank):
+        front = _non_dominated(points[remaining])
+        ranks[remaining[front]] = rank
+        remaining = remaining[~front]
+        rank += 1
+    ranks[remaining] = rank
+    return ranks[inverse]
+
+
+def pareto_front(values: np.ndarray, directions: List[str]) -> np.ndarray:
+
+    """
+    Returns a boolean mask of the points on the Pareto front.
+    """
+
+    return non_dominated_sort(values, directions, max_rank = 1) == 0
+
+
+def _hypervolume_2d(points: np.ndarray, reference: np.ndarray) -> float:
+    # A sweep over the front sorted by f0, where f1 decreases
+    points = points[np.lexsort((points[:, 1], points[:, 0]))]
+    volume, best = 0.0, reference[1]
+    for i, (x, y) in enumerate(points):
+        if y >= best:
+            continue
+        volume += (reference[0] - x) * (best - y)
+        best = y
+    return volume
+
+
+def _hypervolume(points: np.ndarray, reference: np.ndarray) -> float:
+    if len(points) == 0:
+        return 0.0
+    if points.shape[1] == 1:
+        return float(reference[0] - points[:, 0].min())
+    if points.shape[1] == 2:
+        return _hypervolume_2d(points, reference)
+    # Slice along the last objective (HSO): between consecutive values of the last
+    # objective, the volume is the (m-1)-dimensional volume of the points below the slice
+    points = points[np.argsort(points[:, -1])]
+    volume = 0.0
+    for i in range(len(points)):
+        top = points[i + 1, -1] if i + 1 < len(points) else reference[-1]
+        if top <= points[i, -1]:
+            continue
+        below = points[:i + 1, :-1]
+        below = below[_non_dominated(below)] if len(below) > 1 else below
+        volume += (top - points[i, -1]) * _hypervolume(below, reference[:-1])
+    return volume
+
+
+def default_reference(values: np.ndarray, directions: List[str]) -> np.ndarray:
+
+    """
+    Returns a reference point 10% of the range beyond the worst value of each
+    objective, in the original directions of the objectives.
+    """
+
+    points = to_minimize(values, directions)
+    worst, best = points.max(axis = 0), points.min(axis = 0)
+    reference = worst + 0.1 * np.where(worst > best, worst - best, 1.0)
+    return to_minimize(reference[None, :], directions)[0]
+
+
+def hypervolume(values: np.ndarray,
+                directions: List[str],
+                reference: np.ndarray = None) -> float:
+
+    """
+    Returns the volume of the objective space dominated by the points and bounded
+    by the reference point (by default, see default_reference).
+    """
+
+    values = np.asarray(values, dtype = float)
+    if len(values) == 0:
+        return 0.0
+    if reference is None:
+        reference = default_reference(values, directions)
+    points = to_minimize(values, directions)
+    reference = to_minimize(np.asarray(reference, dtype = float)[None, :], directions)[0]
+    points = points[np.all(points < reference, axis = 1)]
+    if len(points) == 0:
+        return 0.0
+    points = np.unique(points, axis = 0)
+    points = points[_non_dominated(points)]
+    return float(_hypervolume(points, reference))
+
+
+def hypervolume_history(values: np.ndarray,
+                        times: np.ndarray,
+                        directions: List[str],
+                        reference: np.ndarray = None,
+                        n_points: int = 100) -> Tuple[np.ndarray, np.ndarray]:
+
+    """
+    Returns the hypervolume of the points finished by each of (at most) n_points
+    times, spread evenly over the finished points. Only the front found so far is
+    carried from one time to the next.
+
+    Inputs:
+        values: an array of n_points x n_objectives
+        times: when each point finished (e.g. hours since the study started)
+        directions: "minimize" or "maximize" for each objective
+        reference: the reference point (by default, see default_reference)
+        n_points: the number of times at which the hypervolume is computed
+    """
+
+    values = np.asarray(values, dtype = float)
+    times = np.asarray(times, dtype = float)
+    if len(values) == 0:
+        return np.array([]), np.array([])
+    if reference is None:
+        reference = default_reference(values, directions)
+
+    order = np.argsort(times, kind = "stable")
+    values, times = values[order], times[order]
+    stops = np.unique(np.linspace(0, len(values), min(n_points, len(values)) + 1).astype(int)[1:])
+
+    front = values[:0]
+    volumes, previous = [], 0
+    for stop in stops:
+        candidates = np.vstack([front, values[previous:stop]])
+        front = candidates[pareto_front(candidates, directions)]
+        volumes.append(hypervolume(front, directions, reference))
+        previous = stop
+    return times[stops - 1], np.array(volumes)
+
+
+def study_values(study: optuna.study.Study,
+                 n_objectives: int) -> Tuple[List[optuna.trial.FrozenTrial], np.ndarray]:
+
+    """
+    Returns the completed trials of a multi-objective study and their values
+    (n_trials x n_objectives), which the study keeps as the first intermediate values.
+    """
+
+    study = getattr(study, "_study", study)
+    trials = [
+        t for t in study.get_trials(deepcopy = False, states = (optuna.trial.TrialState.COMPLETE,))
+        if all([t.intermediate_values.get(i) is not None for i in range(n_objectives)])
+    ]
+    values = np.array(
+        [[t.intermediate_values[i] for i in range(n_objectives)] for t in trials], dtype = float
+    ).reshape(len(trials), n_objectives)
+    return trials, values
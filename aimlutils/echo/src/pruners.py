@@ -4,12 +4,61 @@ warnings.filterwarnings("ignore")
 import sys
 import optuna
 import logging
-from tensorflow.keras.callbacks import Callback
+try:
+    from tensorflow.keras.callbacks import Callback
+except ImportError: # tensorflow is only needed for the KerasPruningCallback
+    Callback = object
 
 
 logger = logging.getLogger(__name__)
 
 
+supported_pruners = [
+    "MedianPruner",
+    "PercentilePruner",
+    "SuccessiveHalvingPruner",
+    "HyperbandPruner",
+    "ThresholdPruner",
+    "PatientPruner",
+    "NopPruner"
+]
+
+
+def pruners(pruner):
+    _type = pruner.pop("type")
+    if _type not in supported_pruners:
+        message = f"Pruner {_type} is not valid. Select from {supported_pruners}"
+        logger.warning(message)
+        raise OSError(message)
+    if not hasattr(optuna.pruners, _type):
+        message = f"Pruner {_type} is not available in optuna {optuna.__version__}. Upgrade optuna to use it."
+        logger.warning(message)
+        raise OSError(message)
+    if _type == "MedianPruner":
+        return optuna.pruners.MedianPruner(**pruner)
+    elif _type == "PercentilePruner":
+        if "percentile" not in pruner:
+            raise OSError("You must provide the percentile option with the PercentilePruner.")
+        return optuna.pruners.PercentilePruner(**pruner)
+    elif _type == "SuccessiveHalvingPruner":
+        return optuna.pruners.SuccessiveHalvingPruner(**pruner)
+    elif _type == "HyperbandPruner":
+        return optuna.pruners.HyperbandPruner(**pruner)
+    elif _type == "ThresholdPruner":
+        if "lower" not in pruner and "upper" not in pruner:
+            raise OSError("You must provide a lower and/or upper option with the ThresholdPruner.")
+        return optuna.pruners.ThresholdPruner(**pruner)
+    elif _type == "PatientPruner":
+        if "patience" not in pruner:
+            raise OSError("You must provide the patience option with the PatientPruner.")
+        wrapped_pruner = pruner.pop("wrapped_pruner", None)
+        if wrapped_pruner is not None:
+            wrapped_pruner = pruners(dict(wrapped_pruner))
+        return optuna.pruners.PatientPruner(wrapped_pruner, **pruner)
+    elif _type == "NopPruner":
+        return optuna.pruners.NopPruner()
+
+
 class KerasPruningCallback(Callback):
 
     def __init__(self, trial, monitor, interval = 1):
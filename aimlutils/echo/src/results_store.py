@@ -0,0 +1,159 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from typing import Dict, List
+import pandas as pd
+import numpy as np
+import logging
+import sqlite3
+import glob
+import io
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+class ResultsStore:
+
+    """
+    A single SQLite file that collects the per-trial results that the workers
+    of a study write to their own csv files (hyper_opt_<N>.csv, see BaseObjective.save).
+
+    The rows of every csv file go into one table, results, with a worker column
+    holding the name of the file they came from (and file_id, the id of the file
+    in the merged_files table). The store remembers how far into each file it has
+    read, so merging again only reads the rows that were appended since. Columns
+    are added to the table as they appear in the files.
+
+    Usage:
+        store = ResultsStore("results.db")
+        store.merge_files(glob.glob("hyper_opt_*.csv"))
+        df = store.to_pandas()
+    """
+
+    def __init__(self, path: str) -> None:
+
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (worker TEXT, file_id INTEGER, line INTEGER)"
+        )
+        # Files that were removed after merging keep their record, so that a new
+        # file with the same name is merged as a different file
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS merged_files (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "path TEXT, header TEXT, offset INTEGER, lines INTEGER, removed INTEGER DEFAULT 0)"
+        )
+        self.connection.commit()
+
+    def columns(self) -> List[str]:
+        return [row[1] for row in self.connection.execute("PRAGMA table_info(results)")]
+
+    def _add_columns(self, columns: List[str]) -> None:
+        existing = self.columns()
+        for column in columns:
+            if column not in existing:
+                self.connection.execute(f'ALTER TABLE results ADD COLUMN "{column}"')
+
+    def append(self, df: pd.DataFrame, worker: str, file_id: int = None, first_line: int = 0) -> None:
+
+        """
+        Inserts the rows of df, tagging them with worker, file_id and their line number.
+        """
+
+        if len(df) == 0:
+            return
+        df = df.astype(object).where(pd.notnull(df), None)
+        columns = ["worker", "file_id", "line"] + [str(c) for c in df.columns]
+        self._add_columns(columns)
+        rows = [
+            [worker, file_id, first_line + i] + [v.item() if isinstance(v, np.generic) else v for v in row]
+            for i, row in enumerate(df.itertuples(index = False, name = None))
+        ]
+        names = ", ".join([f'"{c}"' for c in columns])
+        marks = ", ".join(["?"] * len(columns))
+        self.connection.executemany(f"INSERT INTO results ({names}) VALUES ({marks})", rows)
+
+    def merge_file(self, path: str) -> int:
+
+        """
+        Appends the complete lines that were added to the csv file at path since it
+        was last merged. A file whose header changed (e.g. it gained a column) is merged
+        again from the start. Returns the number of rows that were added.
+        """
+
+        worker = os.path.splitext(os.path.basename(path))[0]
+        record = self.connection.execute(
+            "SELECT id, header, offset, lines FROM merged_files WHERE path = ? AND removed = 0", 
+            (path,)
+        ).fetchone()
+        if record is None:
+            cursor = self.connection.execute(
+                "INSERT INTO merged_files (path, header, offset, lines) VALUES (?, '', 0, 0)", (path,)
+            )
+            record = (cursor.lastrowid, None, 0, 0)
+        file_id, merged_header, offset, lines = record
+
+        with open(path, "rb") as fid:
+            header = fid.readline()
+            if merged_header != header.decode("utf-8") or offset > os.path.getsize(path):
+                if merged_header:
+                    logger.info(f"The columns of {path} changed, merging it again")
+                self.connection.execute("DELETE FROM results WHERE file_id = ?", (file_id,))
+                offset, lines = len(header), 0
+            fid.seek(offset)
+            chunk = fid.read()
+
+        # Leave a partially written last line for the next merge
+        chunk = chunk[:chunk.rfind(b"\n") + 1]
+        added = 0
+        if len(header) and len(chunk):
+            df = pd.read_csv(io.BytesIO(header + chunk))
+            self.append(df, worker, file_id, first_line = lines)
+            added = len(df)
+        self.connection.execute(
+            "UPDATE merged_files SET header = ?, offset = ?, lines = ? WHERE id = ?",
+            (header.decode("utf-8"), offset + len(chunk), lines + added, file_id)
+        )
+        self.connection.commit()
+        return added
+
+    def mark_removed(self, path: str) -> None:
+        self.connection.execute("UPDATE merged_files SET removed = 1 WHERE path = ?", (path,))
+        self.connection.commit()
+
+    def merge_files(self, paths: List[str]) -> Dict[str, int]:
+        return {path: self.merge_file(path) for path in sorted(paths)}
+
+    def to_pandas(self) -> pd.DataFrame:
+        return pd.read_sql_query("SELECT * FROM results ORDER BY file_id, line", self.connection)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def merge_results(save_path: str,
+                  store_path: str = None,
+                  pattern: str = "hyper_opt_*.csv",
+                  remove: bool = False) -> ResultsStore:
+
+    """
+    Merges the worker csv files in save_path into the store at store_path
+    (default save_path/results.db). If remove is True, the csv files are deleted
+    once merged, which should only be done when no worker is writing to them.
+    """
+
+    store_path = store_path or os.path.join(save_path, "results.db")
+    store = ResultsStore(store_path)
+    paths = glob.glob(os.path.join(save_path, pattern))
+    added = store.merge_files(paths)
+    logger.info(
+        f"Merged {sum(added.values())} new rows from {len(paths)} files into {store_path}"
+    )
+    if remove:
+        for path in paths:
+            os.remove(path)
+            store.mark_removed(path)
+        logger.info(f"Removed {len(paths)} merged files from {save_path}")
+    return store
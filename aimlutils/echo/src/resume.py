@@ -0,0 +1,91 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from typing import Dict
+import logging
+import optuna
+
+
+logger = logging.getLogger(__name__)
+
+
+checkpoint_key = "echo:checkpoint_path"
+checkpoint_step_key = "echo:checkpoint_step"
+resume_checkpoint_key = "echo:resume_checkpoint"
+resume_step_key = "echo:resume_step"
+resumed_from_key = "echo:resumed_from"
+
+
+def _storage(trial):
+    trial = getattr(trial, "_trial", trial) # multi-objective trials wrap a trial
+    storage = trial.study._storage
+    # Write around any caching/batching layer so that the record survives the worker being killed
+    return trial, getattr(storage, "_backend", storage)
+
+
+def _flush(trial):
+    # Persist the intermediate values held back by a BatchedStorage (see engine.py)
+    trial = getattr(trial, "_trial", trial)
+    storage = trial.study._storage
+    if hasattr(storage, "flush"):
+        storage.flush(trial._trial_id)
+
+
+def record_checkpoint(trial: optuna.trial.Trial, path: str, step: int) -> None:
+
+    """
+    Records the path of the latest checkpoint of a running trial in its system
+    attributes. step must be the last step passed to trial.report that is covered
+    by the checkpoint.
+    """
+
+    _flush(trial)
+    trial, storage = _storage(trial)
+    storage.set_trial_system_attr(trial._trial_id, checkpoint_key, path)
+    storage.set_trial_system_attr(trial._trial_id, checkpoint_step_key, int(step))
+    logger.debug(f"Recorded checkpoint {path} at step {step} for trial {trial.number}")
+
+
+def latest_trial(trial: optuna.trial.Trial) -> optuna.trial.FrozenTrial:
+
+    """
+    Returns the trial as stored in the backend, including the checkpoint records.
+    """
+
+    trial, storage = _storage(trial)
+    return storage.get_trial(trial._trial_id)
+
+
+def resume_attrs(trial: optuna.trial.FrozenTrial) -> Dict[str, str]:
+
+    """
+    Returns the system attributes that let a new trial resume from the
+    checkpoint of trial, or an empty dictionary if trial has no checkpoint.
+    """
+
+    if checkpoint_key not in trial.system_attrs:
+        return {}
+    return {
+        resume_checkpoint_key: trial.system_attrs[checkpoint_key],
+        resume_step_key: trial.system_attrs[checkpoint_step_key],
+        resumed_from_key: trial.system_attrs.get(resumed_from_key, trial.number)
+    }
+
+
+def resume_state(trial: optuna.trial.Trial) -> Dict[str, str]:
+
+    """
+    If trial continues an interrupted trial, returns a dictionary with the path of
+    the checkpoint to load ("checkpoint"), the last step it covers ("step") and the
+    number of the trial that was first interrupted ("trial"). Otherwise returns None.
+    """
+
+    trial = getattr(trial, "_trial", trial)
+    attrs = trial.system_attrs
+    if resume_checkpoint_key not in attrs:
+        return None
+    return {
+        "checkpoint": attrs[resume_checkpoint_key],
+        "step": int(attrs[resume_step_key]),
+        "trial": attrs[resumed_from_key]
+    }
@@ -1,9 +1,12 @@
 import warnings
 warnings.filterwarnings("ignore")
 
-import sys
+from typing import Dict, List
+import numpy as np
 import optuna
 import logging
+import zlib
+import sys
 
 
 logger = logging.getLogger(__name__)
@@ -21,12 +24,364 @@ supported_samplers = [
 ]
 
 
-def samplers(sampler):
+supported_partitions = ["claim", "index"]
+
+
+def _stratified_value(distribution: optuna.distributions.BaseDistribution, u: float):
+    # Maps u in [0, 1) to the distribution, uniformly in the (log) range
+    if isinstance(distribution, optuna.distributions.CategoricalDistribution):
+        choices = distribution.choices
+        return choices[min(int(u * len(choices)), len(choices) - 1)]
+    low, high = distribution.low, distribution.high
+    log = isinstance(distribution, (
+        optuna.distributions.LogUniformDistribution,
+        optuna.distributions.IntLogUniformDistribution
+    )) or getattr(distribution, "log", False)
+    step = getattr(distribution, "q", None) or getattr(distribution, "step", None)
+    integer = type(distribution).__name__.startswith("Int")
+    if log:
+        value = float(np.exp(np.log(low) + u * (np.log(high) - np.log(low))))
+        if integer:
+            value = int(min(max(round(value), low), high))
+        return value
+    if step is not None:
+        n_steps = int(round((high - low) / step))
+        value = low + min(int(u * (n_steps + 1)), n_steps) * step
+        return int(value) if integer else min(float(value), high)
+    return float(low + u * (high - low))
+
+
+class DistributedSampler(optuna.samplers.BaseSampler):
+
+    """
+    Wraps a sampler for studies with many concurrent workers, staggering the startup
+    trials of the workers.
+
+    The first n_startup_trials trials of the study (by trial number, whichever worker
+    runs them) form a Latin hypercube: for each parameter, trial number n falls in
+    its own stratum of the range, picked by a permutation that only depends on the
+    seed and the parameter name, so the workers spread out instead of drawing
+    independent random points. Later trials are sampled by the wrapped sampler
+    (see samplers, which builds a TPESampler with constant_liar for it).
+
+    Inputs:
+        sampler: the wrapped sampler
+        n_startup_trials: the number of trials in the Latin hypercube (0 to skip it)
+        seed: the seed of the Latin hypercube, which must be the same on every worker
+    """
+
+    def __init__(self,
+                 sampler: optuna.samplers.BaseSampler,
+                 n_startup_trials: int = 10,
+                 seed: int = 0) -> None:
+
+        self._sampler = sampler
+        self._n_startup_trials = n_startup_trials
+        self._seed = 0 if seed is None else seed
+
+    def _startup(self, trial: optuna.trial.FrozenTrial) -> bool:
+        return trial.number < self._n_startup_trials
+
+    def reseed_rng(self) -> None:
+        self._sampler.reseed_rng()
+
+    def infer_relative_search_space(self,
+                                    study: optuna.study.Study,
+                                    trial: optuna.trial.FrozenTrial) -> Dict[str, optuna.distributions.BaseDistribution]:
+        if self._startup(trial):
+            return {}
+        return self._sampler.infer_relative_search_space(study, trial)
+
+    def sample_relative(self,
+                        study: optuna.study.Study,
+                        trial: optuna.trial.FrozenTrial,
+                        search_space: Dict[str, optuna.distributions.BaseDistribution]) -> Dict[str, object]:
+        if self._startup(trial) or len(search_space) == 0:
+            return {}
+        return self._sampler.sample_relative(study, trial, search_space)
+
+    def sample_independent(self,
+                           study: optuna.study.Study,
+                           trial: optuna.trial.FrozenTrial,
+                           param_name: str,
+                           param_distribution: optuna.distributions.BaseDistribution):
+        if self._startup(trial):
+            name_seed = zlib.crc32(param_name.encode("utf-8"))
+            strata = np.random.RandomState((self._seed + name_seed) % 2 ** 32).permutation(self._n_startup_trials)
+            jitter = np.random.RandomState((self._seed + name_seed + trial.number + 1) % 2 ** 32).uniform()
+            u = (strata[trial.number] + jitter) / self._n_startup_trials
+            return _stratified_value(param_distribution, u)
+        return self._sampler.sample_independent(study, trial, param_name, param_distribution)
+
+    def after_trial(self, study, trial, state, values) -> None:
+        if hasattr(self._sampler, "after_trial"):
+            self._sampler.after_trial(study, trial, state, values)
+
+
+class _CachedStudy:
+
+    """
+    A view of a study that returns the same list of trials to every call made
+    while sampling one trial, instead of reading and sorting them each time.
+    """
+
+    def __init__(self, study: optuna.study.Study, trials: List[optuna.trial.FrozenTrial]) -> None:
+        self._wrapped = study
+        self._trials = trials
+        self._by_states = {}
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+    def get_trials(self, deepcopy: bool = True, states = None) -> List[optuna.trial.FrozenTrial]:
+        if states is None:
+            return self._trials
+        key = tuple(states)
+        if key not in self._by_states:
+            self._by_states[key] = [t for t in self._trials if t.state in states]
+        return self._by_states[key]
+
+    @property
+    def trials(self) -> List[optuna.trial.FrozenTrial]:
+        return self._trials
+
+
+class CachedTrialsSampler(optuna.samplers.BaseSampler):
+
+    """
+    Wraps a single-objective sampler so that the trials of the study are read once
+    per sampled trial, rather than once per parameter (which, for database storages,
+    reloads the running trials each time). Only the trials that are new or unfinished
+    are loaded from the database, by optuna's cache (see batched_storage).
+
+    Samplers such as TPE also refit their models on every finished trial, so their
+    time per trial grows with the study. With max_history, the wrapped sampler only
+    sees the running trials and the max_history latest finished trials, a quarter of
+    which are the best trials of the study, so the time per trial stops growing.
+
+    Inputs:
+        sampler: the wrapped sampler
+        max_history: the most finished trials the sampler sees. Default is all of them.
+    """
+
+    def __init__(self, sampler: optuna.samplers.BaseSampler, max_history: int = None) -> None:
+        if max_history is not None and int(max_history) < 4:
+            raise OSError(f"The sampler max_history must be at least 4, not {max_history}")
+        self._sampler = sampler
+        self._max_history = None if max_history is None else int(max_history)
+        self._views = {}
+
+    def _history(self, study: optuna.study.Study) -> List[optuna.trial.FrozenTrial]:
+        trials = study._storage.get_all_trials(study._study_id, deepcopy = False)
+        finished = [t for t in trials if t.state.is_finished()]
+        if self._max_history is None or len(finished) <= self._max_history:
+            return trials
+        complete = [t for t in finished if t.state == optuna.trial.TrialState.COMPLETE and t.value is not None]
+        maximize = study.direction == optuna.study.StudyDirection.MAXIMIZE
+        best = sorted(complete, key = lambda t: t.value, reverse = maximize)[:self._max_history // 4]
+        kept = set([t._trial_id for t in best])
+        for t in sorted(finished, key = lambda t: t.number, reverse = True):
+            if len(kept) >= self._max_history:
+                break
+            kept.add(t._trial_id)
+        return [t for t in trials if not t.state.is_finished() or t._trial_id in kept]
+
+    def _view(self, study: optuna.study.Study, trial: optuna.trial.FrozenTrial) -> _CachedStudy:
+        view = self._views.get(trial._trial_id, None)
+        if view is None:
+            view = _CachedStudy(study, self._history(study))
+            self._views = {trial._trial_id: view}
+        return view
+
+    def reseed_rng(self) -> None:
+        self._sampler.reseed_rng()
+
+    def infer_relative_search_space(self,
+                                    study: optuna.study.Study,
+                                    trial: optuna.trial.FrozenTrial) -> Dict[str, optuna.distributions.BaseDistribution]:
+        return self._sampler.infer_relative_search_space(self._view(study, trial), trial)
+
+    def sample_relative(self,
+                        study: optuna.study.Study,
+                        trial: optuna.trial.FrozenTrial,
+                        search_space: Dict[str, optuna.distributions.BaseDistribution]) -> Dict[str, object]:
+        return self._sampler.sample_relative(self._view(study, trial), trial, search_space)
+
+    def sample_independent(self,
+                           study: optuna.study.Study,
+                           trial: optuna.trial.FrozenTrial,
+                           param_name: str,
+                           param_distribution: optuna.distributions.BaseDistribution):
+        return self._sampler.sample_independent(
+            self._view(study, trial), trial, param_name, param_distribution
+        )
+
+    def after_trial(self, study, trial, state, values) -> None:
+        self._views.pop(trial._trial_id, None)
+        if hasattr(self._sampler, "after_trial"):
+            self._sampler.after_trial(study, trial, state, values)
+
+
+class PartitionedGridSampler(optuna.samplers.GridSampler):
+
+    """
+    A grid sampler for many workers, in which no two trials run the same grid cell.
+
+    With partition = "claim", the cells are put in the study queue once (see
+    enqueue_grid, called by optimize.py) and each worker claims the next one when it
+    asks for a trial; the storage only lets one worker move a queued trial to running.
+    With partition = "index", worker i of n_workers runs the cells i, i + n_workers, ...
+    in order, skipping those already in the study (e.g. after a reload).
+
+    Once there is no cell left for a worker, exhausted returns True. A trial started
+    after that (e.g. a race for the last cell) is pruned when it suggests its
+    first parameter, without evaluating a cell twice.
+
+    Inputs:
+        search_space: the values of each parameter, as for GridSampler
+        partition: "claim" or "index"
+        worker_index: the index of this worker
+        n_workers: the number of workers (partition = "index" only)
+    """
+
+    def __init__(self,
+                 search_space: Dict[str, List[object]],
+                 partition: str = "claim",
+                 worker_index: int = None,
+                 n_workers: int = None) -> None:
+
+        super().__init__(search_space)
+        if partition not in supported_partitions:
+            raise OSError(f"Grid partition {partition} is not valid. Select from {supported_partitions}")
+        if partition == "index" and not n_workers:
+            raise OSError("The index grid partition requires the number of workers in n_workers.")
+        self.partition = partition
+        self.worker_index = worker_index or 0
+        self.n_workers = n_workers
+
+    def _grid_trials(self, study: optuna.study.Study) -> List[optuna.trial.FrozenTrial]:
+        # The trials of this grid (the study may hold trials of other grids or samplers)
+        search_space = {name: list(values) for name, values in self._search_space.items()}
+        return [
+            t for t in study._storage.get_all_trials(study._study_id, deepcopy = False)
+            if t.system_attrs.get("grid_id", None) is not None
+            and t.system_attrs.get("search_space", None) == search_space
+        ]
+
+    def _next_cell(self, study: optuna.study.Study) -> int:
+        taken = set([t.system_attrs["grid_id"] for t in self._grid_trials(study)])
+        own = range(self.worker_index % self.n_workers, len(self._all_grids), self.n_workers)
+        for grid_id in own:
+            if grid_id not in taken:
+                return grid_id
+        return None
+
+    def enqueue_grid(self, study: optuna.study.Study) -> int:
+
+        """
+        Queues the cells that are not yet in the study (cells whose trials failed are
+        queued again) and returns how many were queued.
+        """
+
+        taken = set([
+            t.system_attrs["grid_id"] for t in self._grid_trials(study)
+            if t.state != optuna.trial.TrialState.FAIL
+        ])
+        search_space = {name: list(values) for name, values in self._search_space.items()}
+        n_queued = 0
+        for grid_id, cell in enumerate(self._all_grids):
+            if grid_id in taken:
+                continue
+            study.add_trial(
+                optuna.trial.create_trial(
+                    state = optuna.trial.TrialState.WAITING,
+                    system_attrs = {
+                        "fixed_params": dict(zip(self._param_names, cell)),
+                        "grid_id": grid_id,
+                        "search_space": search_space
+                    }
+                )
+            )
+            n_queued += 1
+        return n_queued
+
+    def exhausted(self, study: optuna.study.Study) -> bool:
+
+        """
+        Returns True when there is no grid cell left for this worker.
+        """
+
+        if hasattr(study._storage, "read_trials_from_remote_storage"):
+            # See the cells claimed by the other workers since the last trial
+            study._storage.read_trials_from_remote_storage(study._study_id)
+        if self.partition == "index":
+            return self._next_cell(study) is None
+        return not any([
+            t.state == optuna.trial.TrialState.WAITING for t in self._grid_trials(study)
+        ])
+
+    def sample_relative(self,
+                        study: optuna.study.Study,
+                        trial: optuna.trial.FrozenTrial,
+                        search_space: Dict[str, optuna.distributions.BaseDistribution]) -> Dict[str, object]:
+        if "grid_id" in trial.system_attrs or "fixed_params" in trial.system_attrs:
+            return {} # a claimed cell, or a retry with its own parameters
+        grid_id = self._next_cell(study) if self.partition == "index" else None
+        study._storage.set_trial_system_attr(trial._trial_id, "search_space", self._search_space)
+        study._storage.set_trial_system_attr(trial._trial_id, "grid_id", grid_id)
+        return {}
+
+    def sample_independent(self,
+                           study: optuna.study.Study,
+                           trial: optuna.trial.FrozenTrial,
+                           param_name: str,
+                           param_distribution: optuna.distributions.BaseDistribution):
+        if trial.system_attrs.get("grid_id", None) is None:
+            raise optuna.TrialPruned("The grid is exhausted.")
+        return super().sample_independent(study, trial, param_name, param_distribution)
+
+    def after_trial(self,
+                    study: optuna.study.Study,
+                    trial: optuna.trial.FrozenTrial,
+                    state: optuna.trial.TrialState,
+                    values) -> None:
+        # The GridSampler calls study.stop() once the grid is used up, counting the
+        # cells of every worker. The workers check exhausted instead.
+        pass
+
+
+def samplers(sampler, worker_index: int = None):
     _type = sampler.pop("type")
     if _type not in supported_samplers:
         message = f"Sampler {_type} is not valid. Select from {supported_samplers}"
         logger.warning(message)
         raise OSError(message)
+    if _type == "GridSampler" and "partition" in sampler:
+        if "search_space" not in sampler:
+            raise OSError("You must provide search_space options with the GridSampler.")
+        if sampler.pop("cache", False) or sampler.pop("distributed", False):
+            raise OSError("The partitioned GridSampler does not support the cache or distributed options.")
+        return PartitionedGridSampler(worker_index = worker_index, **sampler)
+    if sampler.pop("cache", False):
+        if "MultiObjective" in _type:
+            raise OSError("The sampler cache option only supports single-objective samplers.")
+        max_history = sampler.pop("max_history", None)
+        return CachedTrialsSampler(
+            samplers(dict(sampler, type = _type), worker_index = worker_index), max_history = max_history
+        )
+    distributed = sampler.pop("distributed", False)
+    if distributed:
+        # Of the samplers that learn from the trials, optuna only lets TPE see the
+        # running trials (as failures, with constant_liar)
+        if _type != "TPESampler":
+            raise OSError("The distributed sampler option only supports the TPESampler.")
+        distributed = dict(distributed) if isinstance(distributed, dict) else {}
+        distributed.setdefault("n_startup_trials", sampler.get("n_startup_trials", 10))
+        distributed.setdefault("seed", sampler.get("seed", 0))
+        if worker_index is not None and sampler.get("seed", None) is not None:
+            # The same seed would give every worker the same proposals
+            sampler["seed"] = sampler["seed"] + worker_index
+        return DistributedSampler(optuna.samplers.TPESampler(constant_liar = True, **sampler), **distributed)
     if _type == "TPESampler":
         return optuna.samplers.TPESampler(**sampler)
     elif _type == "GridSampler":
@@ -0,0 +1,437 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from aimlutils.echo.src.journal import JournalFileStorage
+from aimlutils.echo.src.instrument import instrumented
+from typing import Callable, Dict, Iterator, List, Set, Tuple, Union
+import functools
+import threading
+import datetime
+import inspect
+import logging
+import random
+import optuna
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Error messages of a database that is busy with the writes of other workers:
+# SQLite locks, MySQL lock wait timeouts and deadlocks, PostgreSQL serialization failures
+contention_errors = [
+    "database is locked",
+    "database table is locked",
+    "database is busy",
+    "lock wait timeout",
+    "deadlock",
+    "could not serialize"
+]
+
+
+def is_contention(error: Exception) -> bool:
+
+    """
+    Returns True if error (or the database error that caused it) means that the
+    database was locked by another connection, so that the call can be retried.
+    """
+
+    messages = [str(error), str(error.__cause__ or ""), str(getattr(error, "orig", "") or "")]
+    message = " ".join(messages).lower()
+    return any([key in message for key in contention_errors])
+
+
+def retry_on_contention(call: Callable,
+                        max_retries: int = 5,
+                        backoff: float = 0.1,
+                        max_backoff: float = 10.0):
+
+    """
+    Returns call(), calling it again up to max_retries times while it fails because
+    the database is locked. Before retry k, the caller sleeps a random time between 0
+    and min(max_backoff, backoff * 2 ** k) seconds, so that workers that collided
+    do not collide again.
+    """
+
+    for attempt in range(max_retries + 1):
+        try:
+            return call()
+        except Exception as error:
+            if attempt == max_retries or not is_contention(error):
+                raise
+            wait = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+            logger.warning(
+                f"The storage is locked ({type(error).__name__}), retrying in {wait:.2f} seconds"
+            )
+            time.sleep(wait)
+
+
+def _retrying(method: Callable) -> Callable:
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        # Only the outermost storage call is retried, since one call may make others
+        if getattr(self._retry_state, "active", False):
+            return method(self, *args, **kwargs)
+        self._retry_state.active = True
+        try:
+            return retry_on_contention(
+                lambda: method(self, *args, **kwargs), 
+                self.max_retries, 
+                self.backoff, 
+                self.max_backoff
+            )
+        finally:
+            self._retry_state.active = False
+    return call
+
+
+class RetryingRDBStorage(optuna.storages.RDBStorage):
+
+    """
+    An RDBStorage whose calls are retried with jittered exponential backoff
+    (see retry_on_contention) when they fail because the database is locked.
+    Failed calls are rolled back by the storage, so they can be repeated.
+
+    Inputs:
+        url: the database url
+        max_retries: how many times a call is retried
+        backoff: the longest wait (seconds) before the first retry
+        max_backoff: the longest wait (seconds) before any retry
+        kwargs: passed on to optuna.storages.RDBStorage
+    """
+
+    def __init__(self,
+                 url: str,
+                 max_retries: int = 5,
+                 backoff: float = 0.1,
+                 max_backoff: float = 10.0,
+                 **kwargs):
+
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._retry_state = threading.local()
+        super().__init__(url, **kwargs)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        del state["_retry_state"]
+        return state
+
+    def __setstate__(self, state):
+        state["_retry_state"] = threading.local()
+        super().__setstate__(state)
+
+
+# The storage interface, plus the bulk calls of the RDBStorage that optuna's cache makes
+_names = [name for name in dir(optuna.storages.BaseStorage) if not name.startswith("_")]
+for _name in _names + ["_get_trials", "_update_trial", "_check_and_set_param_distribution"]:
+    if _name == "remove_session" or not hasattr(optuna.storages.RDBStorage, _name):
+        continue
+    if isinstance(inspect.getattr_static(optuna.storages.RDBStorage, _name), (staticmethod, classmethod)):
+        continue
+    setattr(RetryingRDBStorage, _name, _retrying(getattr(optuna.storages.RDBStorage, _name)))
+
+
+def load_storage(optuna_config: Dict[str, object],
+                 instrument: bool = False) -> Union[str, optuna.storages.BaseStorage]:
+
+    """
+    Returns the storage of the study from the optuna section of the configuration.
+    A journal:///path url returns a JournalFileStorage of the log file at path, with
+    the lock ("flock" or "open") and lock_timeout from storage_options. Otherwise,
+    without storage_options, the storage url is returned as is, and storage_options
+    sets up a RetryingRDBStorage, with
+
+        busy_timeout: seconds an SQLite connection waits for a lock before failing
+        wal: put an SQLite database in write-ahead log mode
+        max_retries, backoff, max_backoff: see retry_on_contention
+        pool_size, max_overflow, pool_pre_ping, pool_recycle: the connection pool of
+            a database server (see sqlalchemy.create_engine)
+
+    Inputs:
+        optuna_config: the optuna section of the hyperparameter configuration
+        instrument: return the storage as an instrumented subclass (see
+            instrument.py), which times every call that reaches the database or
+            journal, also when it is wrapped in optuna's cache or a BatchedStorage
+    """
+
+    url = optuna_config["storage"]
+    options = dict(optuna_config.get("storage_options", {}))
+
+    if url.startswith("journal://"):
+        storage_class = instrumented(JournalFileStorage) if instrument else JournalFileStorage
+        return storage_class(
+            url[len("journal://"):], 
+            lock = options.get("lock", "flock"), 
+            lock_timeout = float(options.get("lock_timeout", 30))
+        )
+    if len(options) == 0:
+        return instrumented(optuna.storages.RDBStorage)(url) if instrument else url
+
+    sqlite = url.startswith("sqlite")
+    engine_kwargs = {}
+    if sqlite:
+        engine_kwargs["connect_args"] = {"timeout": float(options.get("busy_timeout", 5))}
+    else:
+        # SQLite connections are not pooled
+        for key, cast in [("pool_size", int), ("max_overflow", int), ("pool_pre_ping", bool), ("pool_recycle", int)]:
+            if key in options:
+                engine_kwargs[key] = cast(options[key])
+
+    retries = {
+        "max_retries": int(options.get("max_retries", 5)),
+        "backoff": float(options.get("backoff", 0.1)),
+        "max_backoff": float(options.get("max_backoff", 10.0))
+    }
+    # Creating the tables (and switching to WAL) also needs a lock on the database
+    storage_class = instrumented(RetryingRDBStorage) if instrument else RetryingRDBStorage
+    storage = retry_on_contention(
+        lambda: storage_class(url, engine_kwargs = engine_kwargs, **retries), **retries
+    )
+    if sqlite and bool(options.get("wal", False)):
+        def set_wal():
+            with storage.engine.connect() as connection:
+                return connection.exec_driver_sql("PRAGMA journal_mode=WAL").scalar()
+        mode = retry_on_contention(set_wal, **retries)
+        if mode.lower() != "wal":
+            logger.warning(f"Could not switch the SQLite database to WAL mode, the journal mode is {mode}")
+    return storage
+
+
+def rdb_backend(storage: optuna.storages.BaseStorage) -> optuna.storages.RDBStorage:
+
+    """
+    Returns the RDBStorage behind storage (which optuna wraps in a cache),
+    or None if storage is not a database.
+    """
+
+    storage = getattr(storage, "_backend", storage)
+    if isinstance(storage, optuna.storages.RDBStorage):
+        return storage
+    return None
+
+
+def trial_states(storage: optuna.storages.RDBStorage,
+                 study_id: int) -> List[Tuple[int, optuna.trial.TrialState, datetime.datetime]]:
+
+    """
+    Returns (trial_id, state, datetime_complete) for every trial of a study, with a
+    single query on the trials table that skips the params, values and attributes.
+    """
+
+    from optuna.storages._rdb import models
+
+    session = storage.scoped_session()
+    try:
+        rows = session.query(
+            models.TrialModel.trial_id,
+            models.TrialModel.state,
+            models.TrialModel.datetime_complete
+        ).filter(models.TrialModel.study_id == study_id).all()
+    finally:
+        session.close()
+    return [(trial_id, state, complete) for trial_id, state, complete in rows]
+
+
+def get_trials(storage: optuna.storages.RDBStorage,
+               study_id: int,
+               trial_ids: Set[int],
+               excluded_ids: Set[int] = None) -> List[optuna.trial.FrozenTrial]:
+
+    """
+    Returns the trials of a study with the given ids. When the ids of the other
+    trials of the study are given as excluded_ids, the trials are loaded in bulk
+    (which may also return trials created since the ids were listed). Otherwise
+    they are loaded one at a time.
+    """
+
+    if len(trial_ids) == 0:
+        return []
+    if excluded_ids is not None and hasattr(storage, "_get_trials"):
+        return storage._get_trials(study_id, None, set(excluded_ids))
+    return [storage.get_trial(trial_id) for trial_id in trial_ids]
+
+
+def _summary_from_trials(trials: List[optuna.trial.FrozenTrial],
+                         direction: str,
+                         since: datetime.datetime) -> Dict[str, object]:
+    counts = {}
+    for t in trials:
+        counts[t.state.name] = counts.get(t.state.name, 0) + 1
+    complete = [
+        t for t in trials if t.state == optuna.trial.TrialState.COMPLETE and t.value is not None
+    ]
+    best = None
+    if isinstance(direction, str) and len(complete):
+        pick = min if direction == "minimize" else max
+        best = pick(complete, key = lambda t: t.value)
+    return {
+        "counts": counts,
+        "best_value": best.value if best is not None else None,
+        "best_trial": best.number if best is not None else None,
+        "recent": len([
+            t for t in trials 
+            if t.datetime_complete is not None and t.datetime_complete >= since
+        ])
+    }
+
+
+def study_summary(storage: Union[str, optuna.storages.BaseStorage],
+                  study_name: str,
+                  direction: Union[str, List[str]],
+                  window: float = 1.0) -> Dict[str, object]:
+
+    """
+    Returns the number of trials in each state ("counts"), the best value and the
+    number of the trial that reached it for single-objective studies ("best_value",
+    "best_trial"), and the number of trials that finished in the last window hours
+    ("recent") and per hour ("trials_per_hour").
+
+    For database storages these come from aggregate queries, without loading the trials.
+    """
+
+    storage = optuna.storages.get_storage(storage)
+    study_id = storage.get_study_id_from_name(study_name)
+    since = datetime.datetime.now() - datetime.timedelta(hours = window)
+    backend = rdb_backend(storage)
+
+    if backend is None:
+        summary = _summary_from_trials(
+            storage.get_all_trials(study_id, deepcopy = False), direction, since
+        )
+    else:
+        from optuna.storages._rdb import models
+        from sqlalchemy import func
+
+        session = backend.scoped_session()
+        try:
+            counts = session.query(
+                models.TrialModel.state, func.count(models.TrialModel.trial_id)
+            ).filter(
+                models.TrialModel.study_id == study_id
+            ).group_by(models.TrialModel.state).all()
+
+            recent = session.query(func.count(models.TrialModel.trial_id)).filter(
+                models.TrialModel.study_id == study_id,
+                models.TrialModel.datetime_complete >= since
+            ).scalar()
+
+            best = None
+            if isinstance(direction, str):
+                # Older versions of optuna keep the value in the trials table
+                if hasattr(models, "TrialValueModel"):
+                    value = models.TrialValueModel.value
+                    query = session.query(models.TrialModel.number, value).join(
+                        models.TrialValueModel, 
+                        models.TrialValueModel.trial_id == models.TrialModel.trial_id
+                    ).filter(models.TrialValueModel.objective == 0)
+                else:
+                    value = models.TrialModel.value
+                    query = session.query(models.TrialModel.number, value)
+                order = value.asc() if direction == "minimize" else value.desc()
+                best = query.filter(
+                    models.TrialModel.study_id == study_id,
+                    models.TrialModel.state == optuna.trial.TrialState.COMPLETE
+                ).order_by(order).first()
+        finally:
+            session.close()
+
+        summary = {
+            "counts": {state.name: count for state, count in counts},
+            "best_value": best[1] if best is not None else None,
+            "best_trial": best[0] if best is not None else None,
+            "recent": recent
+        }
+
+    summary["trials_per_hour"] = summary["recent"] / window
+    return summary
+
+
+def trial_keys(storage: Union[str, optuna.storages.BaseStorage],
+               study_name: str) -> Dict[str, Dict[str, str]]:
+
+    """
+    Returns the names of the parameters of a study (with the json of their
+    distribution, under "params") and the keys of its user and system attributes
+    (under "user_attrs" and "system_attrs"). For database storages these come
+    from distinct queries, without loading the trials.
+    """
+
+    storage = optuna.storages.get_storage(storage)
+    study_id = storage.get_study_id_from_name(study_name)
+    backend = rdb_backend(storage)
+
+    if backend is None:
+        keys = {"params": {}, "user_attrs": {}, "system_attrs": {}}
+        for t in storage.get_all_trials(study_id, deepcopy = False):
+            for name, dist in t.distributions.items():
+                keys["params"].setdefault(name, optuna.distributions.distribution_to_json(dist))
+            keys["user_attrs"].update({key: None for key in t.user_attrs})
+            keys["system_attrs"].update({key: None for key in t.system_attrs})
+        return keys
+
+    from optuna.storages._rdb import models
+
+    session = backend.scoped_session()
+    try:
+        def distinct(*columns):
+            model = columns[0].class_
+            return session.query(*columns).join(
+                models.TrialModel, models.TrialModel.trial_id == model.trial_id
+            ).filter(models.TrialModel.study_id == study_id).distinct().all()
+
+        params = {}
+        for name, dist in distinct(models.TrialParamModel.param_name, models.TrialParamModel.distribution_json):
+            params.setdefault(name, dist)
+        keys = {
+            "params": params,
+            "user_attrs": {key: None for (key,) in distinct(models.TrialUserAttributeModel.key)},
+            "system_attrs": {key: None for (key,) in distinct(models.TrialSystemAttributeModel.key)}
+        }
+    finally:
+        session.close()
+    return keys
+
+
+def iter_trials(storage: Union[str, optuna.storages.BaseStorage],
+                study_name: str,
+                chunk_size: int = 1000) -> Iterator[List[optuna.trial.FrozenTrial]]:
+
+    """
+    Yields the trials of a study in chunks of chunk_size, ordered by trial id.
+    For database storages only one chunk is loaded at a time.
+    """
+
+    storage = optuna.storages.get_storage(storage)
+    study_id = storage.get_study_id_from_name(study_name)
+    backend = rdb_backend(storage)
+
+    if backend is None:
+        trials = storage.get_all_trials(study_id, deepcopy = False)
+        for i in range(0, len(trials), chunk_size):
+            yield trials[i:i + chunk_size]
+        return
+
+    from optuna.storages._rdb import models
+    from sqlalchemy import orm
+
+    trial_ids = sorted([row[0] for row in trial_states(backend, study_id)])
+    for i in range(0, len(trial_ids), chunk_size):
+        chunk = trial_ids[i:i + chunk_size]
+        if not hasattr(backend, "_build_frozen_trial_from_trial_model"):
+            yield [backend.get_trial(trial_id) for trial_id in chunk]
+            continue
+        session = backend.scoped_session()
+        try:
+            query = session.query(models.TrialModel)
+            for relation in ["params", "values", "user_attributes", "system_attributes", "intermediate_values"]:
+                if hasattr(models.TrialModel, relation): # values was added in optuna 2.4
+                    query = query.options(orm.selectinload(getattr(models.TrialModel, relation)))
+            trial_models = query.filter(
+                models.TrialModel.trial_id.in_(chunk)
+            ).order_by(models.TrialModel.trial_id).all()
+            trials = [backend._build_frozen_trial_from_trial_model(t) for t in trial_models]
+        finally:
+            session.close()
+        yield trials
@@ -0,0 +1,192 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from aimlutils.echo.src.storage import rdb_backend, trial_states, get_trials
+from typing import Dict, List, Union
+import pandas as pd
+import numpy as np
+import logging
+import optuna
+import json
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+columns = [
+    "trial_id", "number", "state", "values", "datetime_start", "datetime_complete",
+    "params", "distributions", "user_attrs", "system_attrs", "intermediate_values"
+]
+
+
+def _timestamp(value):
+    return None if value is None or pd.isnull(value) else pd.Timestamp(value).to_pydatetime()
+
+
+def _to_row(trial: optuna.trial.FrozenTrial) -> Dict[str, object]:
+    return {
+        "trial_id": trial._trial_id,
+        "number": trial.number,
+        "state": trial.state.name,
+        "values": json.dumps(trial.values),
+        "datetime_start": trial.datetime_start,
+        "datetime_complete": trial.datetime_complete,
+        "params": json.dumps(trial.params),
+        "distributions": json.dumps({
+            name: optuna.distributions.distribution_to_json(dist)
+            for name, dist in trial.distributions.items()
+        }),
+        "user_attrs": json.dumps(trial.user_attrs),
+        "system_attrs": json.dumps(trial.system_attrs),
+        "intermediate_values": json.dumps(trial.intermediate_values)
+    }
+
+
+def _to_trial(row) -> optuna.trial.FrozenTrial:
+    values = json.loads(row["values"])
+    return optuna.trial.FrozenTrial(
+        number = int(row["number"]),
+        state = optuna.trial.TrialState[row["state"]],
+        value = None,
+        values = values,
+        datetime_start = _timestamp(row["datetime_start"]),
+        datetime_complete = _timestamp(row["datetime_complete"]),
+        params = json.loads(row["params"]),
+        distributions = {
+            name: optuna.distributions.json_to_distribution(dist)
+            for name, dist in json.loads(row["distributions"]).items()
+        },
+        user_attrs = json.loads(row["user_attrs"]),
+        system_attrs = json.loads(row["system_attrs"]),
+        intermediate_values = {
+            int(step): value for step, value in json.loads(row["intermediate_values"]).items()
+        },
+        trial_id = int(row["trial_id"])
+    )
+
+
+class TrialCache:
+
+    """
+    A local Parquet copy of the trials of a study, so that reports do not pull
+    every trial from the database on every run.
+
+    On each sync, the (trial_id, state, datetime_complete) of every trial is read
+    with one light query, and only the trials that are new, changed state or finished,
+    or are still running (their intermediate values change) are loaded from the storage.
+    Trials that no longer exist in the storage are dropped. Storages that are not
+    databases are loaded in full.
+
+    Usage:
+        cache = TrialCache("study_trials.parquet")
+        trials = cache.sync(storage, study_name)
+    """
+
+    def __init__(self, path: str) -> None:
+
+        self.path = path
+        if os.path.isfile(path):
+            self.df = pd.read_parquet(path)
+        else:
+            self.df = pd.DataFrame(columns = columns)
+        # Trials already rebuilt from the rows, by trial id (kept by long-lived reports)
+        self._frozen = {}
+
+    def _changed(self, rows) -> List[int]:
+        cached = {
+            trial_id: (state, _timestamp(complete)) for trial_id, state, complete in zip(
+                self.df["trial_id"], self.df["state"], self.df["datetime_complete"]
+            )
+        }
+        unfinished = (optuna.trial.TrialState.RUNNING, optuna.trial.TrialState.WAITING)
+        return [
+            trial_id for trial_id, state, complete in rows
+            if state in unfinished or cached.get(trial_id, None) != (state.name, complete)
+        ]
+
+    def sync(self,
+             storage: Union[str, optuna.storages.BaseStorage],
+             study_name: str) -> List[optuna.trial.FrozenTrial]:
+
+        """
+        Brings the cache up to date with the study and returns all of its trials.
+        """
+
+        start = time.time()
+        storage = optuna.storages.get_storage(storage)
+        study_id = storage.get_study_id_from_name(study_name)
+        backend = rdb_backend(storage)
+
+        if backend is not None:
+            rows = trial_states(backend, study_id)
+            changed = self._changed(rows)
+            unchanged = set([row[0] for row in rows]) - set(changed)
+            trials = get_trials(backend, study_id, changed, excluded_ids = unchanged)
+            keep = self.df[self.df["trial_id"].isin(unchanged)]
+        else:
+            trials = storage.get_all_trials(study_id, deepcopy = False)
+            keep = self.df.iloc[:0]
+
+        for t in trials:
+            self._frozen[t._trial_id] = t
+        fetched = pd.DataFrame([_to_row(t) for t in trials], columns = columns)
+        self.df = pd.concat([keep, fetched], ignore_index = True)
+        self.df = self.df.sort_values("number", kind = "stable").reset_index(drop = True)
+        self.save()
+        logger.info(
+            f"Loaded {len(fetched)} new or changed trials ({len(self.df)} in total) in {time.time() - start:.1f} seconds"
+        )
+        return self.trials()
+
+    def trials(self) -> List[optuna.trial.FrozenTrial]:
+        ids = set(self.df["trial_id"])
+        self._frozen = {trial_id: t for trial_id, t in self._frozen.items() if trial_id in ids}
+        missing = self.df[~self.df["trial_id"].isin(list(self._frozen))]
+        for row in missing.to_dict(orient = "records"):
+            self._frozen[int(row["trial_id"])] = _to_trial(row)
+        return [self._frozen[trial_id] for trial_id in self.df["trial_id"]]
+
+    def save(self) -> None:
+        df = self.df.copy()
+        for column in ["datetime_start", "datetime_complete"]:
+            df[column] = pd.to_datetime(df[column])
+        for column in ["trial_id", "number"]:
+            df[column] = df[column].astype(np.int64)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        df.to_parquet(tmp_path, index = False)
+        os.replace(tmp_path, self.path)
+
+
+def load_cached_study(study_name: str,
+                      storage: str,
+                      direction: Union[str, List[str]],
+                      cache_path: str) -> optuna.study.Study:
+
+    """
+    Returns an in-memory copy of a study (single or multi-objective) built from
+    its trial cache at cache_path, after syncing the cache with the storage.
+    """
+
+    trials = TrialCache(cache_path).sync(storage, study_name)
+    return study_from_trials(trials, study_name, direction)
+
+
+def study_from_trials(trials: List[optuna.trial.FrozenTrial],
+                      study_name: str,
+                      direction: Union[str, List[str]]) -> optuna.study.Study:
+
+    """
+    Returns an in-memory study (single or multi-objective) holding trials.
+    """
+
+    if isinstance(direction, str):
+        study = optuna.create_study(study_name = study_name, direction = direction)
+        study.add_trials(trials)
+    else:
+        study = optuna.multi_objective.study.create_study(
+            study_name = study_name, directions = direction
+        )
+        study._study.add_trials(trials)
+    return study
@@ -0,0 +1,179 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from aimlutils.echo.src.heartbeat import heartbeat_key, worker_key
+from collections import defaultdict
+from typing import Dict, List, Tuple
+import matplotlib.pyplot as plt
+import numpy as np
+import datetime
+import logging
+import optuna
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+colors = {
+    "COMPLETE": "tab:green",
+    "PRUNED": "tab:orange",
+    "FAIL": "tab:red",
+    "RUNNING": "tab:blue"
+}
+
+
+def trial_intervals(trials: List[optuna.trial.FrozenTrial],
+                    now: datetime.datetime = None) -> List[Dict[str, object]]:
+
+    """
+    Returns the start and end (in seconds since the first trial started), state and
+    worker of each trial that started. Running trials end now. Failed trials without
+    an end (e.g. whose worker was killed) end at their last heartbeat when they have one.
+    """
+
+    now = now or datetime.datetime.now()
+    started = [t for t in trials if t.datetime_start is not None]
+    if len(started) == 0:
+        return []
+    t0 = min([t.datetime_start for t in started])
+
+    intervals = []
+    for t in started:
+        end = t.datetime_complete
+        if t.state == optuna.trial.TrialState.RUNNING:
+            end = now
+        last_beat = t.system_attrs.get(heartbeat_key, None)
+        if t.state == optuna.trial.TrialState.FAIL and last_beat is not None:
+            # A reaped trial is finished long after its worker died
+            end = min(end or now, datetime.datetime.fromtimestamp(last_beat))
+        if end is None:
+            continue
+        intervals.append({
+            "number": t.number,
+            "start": (t.datetime_start - t0).total_seconds(),
+            "end": max((end - t0).total_seconds(), (t.datetime_start - t0).total_seconds()),
+            "state": t.state.name,
+            "worker": t.system_attrs.get(worker_key, None)
+        })
+    return sorted(intervals, key = lambda x: x["start"])
+
+
+def assign_lanes(intervals: List[Dict[str, object]]) -> Dict[str, List[Dict[str, object]]]:
+
+    """
+    Groups the intervals by worker. Workers are taken from the worker names that
+    every trial records when it starts (see AskTellWorker). The other trials (e.g.
+    run by older versions of ECHO) are packed greedily into lanes,
+    each trial going to the first lane that was free when it started, so a lane is
+    a lower bound on the activity of one worker slot.
+    """
+
+    lanes = defaultdict(list)
+    ends = [] # the end of the last trial in each anonymous lane
+    for interval in intervals:
+        if interval["worker"] is not None:
+            lanes[interval["worker"]].append(interval)
+            continue
+        for i, end in enumerate(ends):
+            if end <= interval["start"]:
+                break
+        else:
+            i = len(ends)
+            ends.append(0)
+        ends[i] = interval["end"]
+        lanes[f"lane {i}"].append(interval)
+    return dict(lanes)
+
+
+def concurrency(intervals: List[Dict[str, object]]) -> Tuple[np.ndarray, np.ndarray]:
+
+    """
+    Returns the times at which the number of running trials changes and that number
+    just after each time.
+    """
+
+    if len(intervals) == 0:
+        return np.array([]), np.array([])
+    events = sorted(
+        [(x["start"], 1) for x in intervals] + [(x["end"], -1) for x in intervals],
+        key = lambda e: (e[0], e[1])
+    )
+    times = np.array([e[0] for e in events])
+    counts = np.cumsum([e[1] for e in events])
+    return times, counts
+
+
+def utilization_summary(lanes: Dict[str, List[Dict[str, object]]]) -> Dict[str, float]:
+
+    """
+    Returns, in hours: the time spent in completed, pruned and failed (killed or
+    broken) trials, the idle time of the workers between their first and last trial,
+    and the mean and peak number of concurrent trials.
+    """
+
+    intervals = [x for lane in lanes.values() for x in lane]
+    summary = {"workers": len(lanes)}
+    for state in ["COMPLETE", "PRUNED", "FAIL", "RUNNING"]:
+        summary[f"{state.lower()}_hours"] = sum(
+            [x["end"] - x["start"] for x in intervals if x["state"] == state]
+        ) / 3600
+
+    idle = 0.0
+    for lane in lanes.values():
+        lane = sorted(lane, key = lambda x: x["start"])
+        last_end = lane[0]["end"]
+        for x in lane[1:]:
+            idle += max(0.0, x["start"] - last_end)
+            last_end = max(last_end, x["end"])
+    summary["idle_hours"] = idle / 3600
+
+    times, counts = concurrency(intervals)
+    if len(times) > 1:
+        summary["mean_concurrency"] = float(np.sum(counts[:-1] * np.diff(times)) / (times[-1] - times[0]))
+        summary["peak_concurrency"] = int(counts.max())
+    return summary
+
+
+def plot_utilization(lanes: Dict[str, List[Dict[str, object]]],
+                     save_path: str,
+                     extension: str = "pdf") -> str:
+
+    """
+    Saves a Gantt chart of the trials of each worker above the number of
+    concurrent trials over time. Returns the path of the figure.
+    """
+
+    intervals = [x for lane in lanes.values() for x in lane]
+    names = sorted(lanes)
+    fig, (gantt, curve) = plt.subplots(
+        2, 1, sharex = True, figsize = (10, 2 + 0.2 * len(names)),
+        gridspec_kw = {"height_ratios": [3, 1]}
+    )
+
+    for row, name in enumerate(names):
+        for state, color in colors.items():
+            bars = [
+                (x["start"] / 3600, (x["end"] - x["start"]) / 3600)
+                for x in lanes[name] if x["state"] == state
+            ]
+            if len(bars):
+                gantt.broken_barh(bars, (row - 0.4, 0.8), facecolors = color, rasterized = len(intervals) > 1000)
+    gantt.set_yticks(range(len(names)))
+    gantt.set_yticklabels(names, fontsize = 6)
+    gantt.set_ylabel("Worker")
+    gantt.legend(
+        handles = [plt.Rectangle((0, 0), 1, 1, color = c) for c in colors.values()],
+        labels = [s.lower() for s in colors], loc = "upper right", fontsize = 6
+    )
+
+    times, counts = concurrency(intervals)
+    curve.step(times / 3600, counts, where = "post")
+    curve.set_xlabel("Hours since the first trial started")
+    curve.set_ylabel("Running trials")
+
+    plt.tight_layout()
+    figure_save_path = os.path.join(save_path, f"utilization.{extension}")
+    plt.savefig(figure_save_path)
+    plt.close(fig)
+    return figure_save_path
@@ -0,0 +1,137 @@
+import warnings
+warnings.filterwarnings("ignore")
+
+from contextlib import contextmanager
+from typing import Dict, List
+import numpy as np
+import logging
+import optuna
+import signal
+
+
+logger = logging.getLogger(__name__)
+
+
+class TrialTimeout(Exception):
+    """Raised inside a trial that ran past its time limit."""
+    pass
+
+
+class TrialTerminated(TrialTimeout):
+    """Raised inside a trial when the worker receives SIGTERM, e.g. from scancel or pre-emption."""
+    pass
+
+
+class WallTimeExceeded(Exception):
+    """Raised before training a trial that is not expected to finish before the wall-time."""
+    pass
+
+
+def _distance(a, b):
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        if a > 0 and b > 0: # compare sizes/rates on a log scale
+            return abs(np.log(a) - np.log(b))
+        return abs(a - b)
+    return float(a != b)
+
+
+def completed_trial_durations(study: optuna.study.Study,
+                              params: Dict[str, float] = None,
+                              condition_on: List[str] = None,
+                              k: int = 5) -> List[float]:
+
+    """
+    Returns the run times (in seconds) of the completed trials in the storage.
+
+    If params and condition_on are supplied, only the k trials whose
+    values of the condition_on parameters are closest to params are used
+    (e.g. trials that used the same batch size).
+
+    Inputs:
+        study: an Optuna study object
+        params: the parameters of the trial that is about to run
+        condition_on: names of the parameters to condition the estimate on
+        k: the number of nearest trials to use when conditioning
+    """
+
+    study = getattr(study, "_study", study) # multi-objective studies wrap a study
+    trials = [
+        t for t in study.get_trials(deepcopy = False)
+        if t.state == optuna.trial.TrialState.COMPLETE
+        and t.datetime_start is not None
+        and t.datetime_complete is not None
+    ]
+    durations = np.array([
+        (t.datetime_complete - t.datetime_start).total_seconds() for t in trials
+    ])
+
+    names = [name for name in (condition_on or []) if params and name in params]
+    if len(names) == 0 or len(trials) <= k:
+        return list(durations)
+
+    distances = np.array([
+        sum([_distance(t.params[name], params[name]) if name in t.params else np.inf for name in names])
+        for t in trials
+    ])
+    exact = distances == 0
+    if exact.sum() >= k:
+        return list(durations[exact])
+    return list(durations[np.argsort(distances, kind = "stable")[:k]])
+
+
+def estimate_run_time(durations: List[float],
+                      n_sigma: float = 2.0,
+                      min_trials: int = 3) -> float:
+
+    """
+    Returns a conservative estimate (mean + n_sigma * std) of how long a trial
+    will take, or None if there are fewer than min_trials durations to go on.
+    """
+
+    if len(durations) < min_trials:
+        return None
+    return float(np.mean(durations) + n_sigma * np.std(durations))
+
+
+@contextmanager
+def trial_timeout(seconds: float):
+
+    """
+    Raises TrialTimeout inside the with-block once seconds have elapsed.
+    Uses SIGALRM, so it must be entered from the main thread of the process.
+    Does nothing if seconds is None.
+    """
+
+    if seconds is None:
+        yield
+        return
+
+    def handler(signum, frame):
+        raise TrialTimeout(f"The trial exceeded its time limit of {seconds:.0f} seconds")
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, max(seconds, 1.0))
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+@contextmanager
+def terminate_trial_on_sigterm():
+
+    """
+    Raises TrialTerminated inside the with-block when the process receives SIGTERM
+    (which slurm and pbs send before killing a cancelled or pre-empted job), so that
+    the trial can be stopped and handed on. Must be entered from the main thread.
+    """
+
+    def handler(signum, frame):
+        raise TrialTerminated("The worker received SIGTERM")
+
+    previous = signal.signal(signal.SIGTERM, handler)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTERM, previous)
@@ -1,3 +1,4 @@
+from aimlutils.utils.writers import CSVWriter
 from collections import defaultdict
 from typing import List, Dict
 import pandas as pd
@@ -27,7 +28,8 @@ class EarlyStopping:
                  delta=0,
                  save_every_epoch=False,
                  path_save='checkpoint.pt',
-                 tag = None):
+                 tag = None,
+                 on_save = None):
         """
         Args:
             patience (int): How long to wait after last time validation loss improved.
@@ -40,6 +42,10 @@ class EarlyStopping:
                             Default: 'checkpoint.pt'
             trace_func (function): trace print function.
                             Default: print            
+            on_save (function): called as on_save(epoch, path) after a checkpoint is written, 
+                            e.g. to record the path in an optuna trial. A checkpoint is then
+                            written every epoch, so path is always the latest epoch's.
+                            Default: None
         """
         self.patience = patience
         self.verbose = verbose
@@ -52,6 +58,7 @@ class EarlyStopping:
         self.dirpath = os.path.dirname(self.path)
         self.save_every_epoch = save_every_epoch
         self.tag = tag
+        self.on_save = on_save
 
         logger.info(
             f"Loaded EarlyStopping checkpointer with patience {self.patience}")
@@ -71,7 +78,8 @@ class EarlyStopping:
             self.counter += 1
             logger.info(
                 f'EarlyStopping counter: {self.counter} out of {self.patience}')
-            if self.save_every_epoch:
+            # A resumed trial continues from the latest epoch, not the best one
+            if self.save_every_epoch or self.on_save is not None:
                 self.save_checkpoint(
                     epoch, val_loss, model, optimizer, best=False)
             if self.counter >= self.patience:
@@ -103,6 +111,8 @@ class EarlyStopping:
                 save_path = os.path.join(self.dirpath, "best.pt")
             torch.save(checkpoint, save_path)
             self.val_loss_min = val_loss
+        if self.on_save is not None:
+            self.on_save(epoch, save_path)
 
     def print_learning_rate(self, optimizer):
         for param_group in optimizer.param_groups:
@@ -121,28 +131,27 @@ class MetricsLogger:
                 f"Loaded a previous metrics file from {self.path_save}")
         else:
             self.metrics = defaultdict(list)
+            if os.path.isfile(self.path_save):
+                os.remove(self.path_save)
             logger.info(
                 f"Loaded a metrics logger {self.path_save} to track the training results")
+        # Appends each update to the file instead of rewriting it
+        self.writer = CSVWriter(self.path_save)
 
     def update(self, data: Dict[str, float]) -> None:
         for key, value in data.items():
             self.metrics[key].append(value)
-        self.save()
+        self.writer.write(data)
 
     def to_pandas(self) -> pd.DataFrame:
         return pd.DataFrame.from_dict(self.metrics)
 
     def save(self) -> None:
-        self.to_pandas().to_csv(
-            self.path_save,
-            sep=',',
-            encoding='utf-8',
-            index=None
-        )
+        self.writer.flush()
 
     def load(self) -> None:
-        self.metrics = pd.read_csv(
+        self.metrics = defaultdict(list, pd.read_csv(
             self.path_save,
             sep=',',
             encoding='utf-8'
-        ).to_dict()
+        ).to_dict(orient="list"))
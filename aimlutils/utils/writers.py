@@ -0,0 +1,97 @@
+from typing import Dict, List
+import logging
+import time
+import csv
+import io
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+class CSVWriter:
+
+    """
+    Appends rows to a csv file instead of rewriting the whole file on every update.
+
+    Rows are buffered and appended every flush_every rows, or once flush_interval
+    seconds have passed since the last flush. Each flush appends complete lines in
+    a single write, so the file can be read (e.g. with pandas) while it is written.
+    The columns are fixed by the header; a row with new columns widens the header by
+    rewriting the file to a temporary file that then replaces it, with the new columns
+    left empty in the earlier rows. An existing file is appended to.
+
+    Usage:
+        writer = CSVWriter("results.csv")
+        writer.write({"epoch": 0, "loss": 1.0})
+        writer.close()
+    """
+
+    def __init__(self, path: str, flush_every: int = 1, flush_interval: float = None) -> None:
+
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.columns = self._read_header()
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def _read_header(self) -> List[str]:
+        if not os.path.isfile(self.path) or os.path.getsize(self.path) == 0:
+            return []
+        with open(self.path, newline = "") as fid:
+            return next(csv.reader(fid), [])
+
+    def write(self, row: Dict[str, object]) -> None:
+        self.buffer.append({str(key): value for key, value in row.items()})
+        due = (
+            self.flush_interval is not None
+            and (time.time() - self.last_flush) >= self.flush_interval
+        )
+        if len(self.buffer) >= self.flush_every or due:
+            self.flush()
+
+    def flush(self) -> None:
+        self.last_flush = time.time()
+        if len(self.buffer) == 0:
+            return
+
+        new_columns = []
+        for row in self.buffer:
+            new_columns += [key for key in row if key not in self.columns and key not in new_columns]
+
+        lines = io.StringIO()
+        if len(self.columns) == 0: # a new file starts with the header
+            self.columns = new_columns
+            csv.writer(lines).writerow(self.columns)
+        elif len(new_columns):
+            self._widen(new_columns)
+
+        writer = csv.DictWriter(lines, fieldnames = self.columns, restval = "")
+        writer.writerows(self.buffer)
+        with open(self.path, "a", newline = "") as fid:
+            fid.write(lines.getvalue())
+        self.buffer = []
+
+    def _widen(self, new_columns: List[str]) -> None:
+        logger.debug(f"Adding the columns {new_columns} to {self.path}")
+        columns = self.columns + new_columns
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(self.path, newline = "") as src, open(tmp_path, "w", newline = "") as dst:
+            reader = csv.reader(src)
+            writer = csv.writer(dst)
+            next(reader, None)
+            writer.writerow(columns)
+            for line in reader:
+                writer.writerow(line + [""] * len(new_columns))
+        os.replace(tmp_path, self.path)
+        self.columns = columns
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
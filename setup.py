@@ -51,6 +51,11 @@ setup(
     keywords="",
     install_requires=required_libraries,
     packages=find_packages(exclude=['aimlutils/tests']),
+    entry_points={
+        'console_scripts': [
+            'echo-merge=aimlutils.echo.merge:main',
+        ],
+    },
 #    test_suite='tests',
     zip_safe=False,
 )